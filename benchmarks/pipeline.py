@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Benchmark of the complete pipeline: usage record generation from Maui and
+# Torque logs, and registration to a (local) SGAS service.
+#
+# Synthetic logs are written to a temporary directory (see synthetic.py), the
+# generator is run on them, and the registrant then registers the spooled
+# records to the SGAS stand-in (see sgas_server.py). Each stage runs in its
+# own process, and records/sec, peak memory (max rss) and wall time is
+# reported for it.
+#
+# Usage: python benchmarks/pipeline.py [options], see --help
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..')
+
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, SOURCE_DIR)
+
+from lrmsurgen import spool
+import synthetic
+import sgas_server
+
+
+GENERATOR  = os.path.join(SOURCE_DIR, 'lrms-ur-generator')
+REGISTRANT = os.path.join(SOURCE_DIR, 'lrms-ur-registrant')
+
+LOG_WRITERS = {
+    'maui'   : synthetic.writeMauiTraces,
+    'torque' : synthetic.writeTorqueLogs,
+}
+
+
+
+def getParser():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-l', '--lrms', dest='lrms', default='maui,torque',
+                      help='LRMS logs to benchmark (maui, torque or both, default: %default)')
+    parser.add_option('-j', '--jobs-per-day', dest='jobs_per_day', type='int', default=synthetic.DEFAULT_JOBS_PER_DAY,
+                      help='Jobs in each daily log (default: %default)')
+    parser.add_option('-d', '--days', dest='days', type='int', default=synthetic.DEFAULT_DAYS,
+                      help='Number of daily logs (default: %default)')
+    parser.add_option('--shapes', dest='shapes', default=synthetic.DEFAULT_SHAPES,
+                      help='Job shapes as nodes:ppn pairs (default: %default)')
+    parser.add_option('--spool', dest='spool', default=spool.SPOOL_FILES,
+                      help='Spool format, files or segments (default: %default)')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='Generator worker processes (default: %default)')
+    parser.add_option('--batch-records', dest='batch_records', type='int', default=0,
+                      help='Generator batch_records setting (default: %default)')
+    parser.add_option('--latency', dest='latency', type='float', default=0,
+                      help='Latency of the SGAS stand-in in seconds (default: %default)')
+    parser.add_option('--error-rate', dest='error_rate', type='float', default=0,
+                      help='Fraction of uploads failing with 503 (default: %default)')
+    parser.add_option('--compress', dest='compress', default='',
+                      help='Registrant compress setting, e.g. "all"')
+    parser.add_option('--certificate', dest='certificate',
+                      help='Serve HTTPS with this certificate (also used as client certificate)')
+    parser.add_option('--key', dest='key', help='Key for the certificate')
+    parser.add_option('--ca-dir', dest='ca_dir', help='CA directory for the registrant, when using HTTPS')
+    parser.add_option('--port', dest='port', type='int', default=sgas_server.DEFAULT_PORT,
+                      help='Port of the SGAS stand-in (default: %default)')
+    parser.add_option('--keep', dest='keep', action='store_true', default=False,
+                      help='Keep the benchmark directory')
+    return parser
+
+
+def writeConfig(path, sections):
+    f = open(path, 'w')
+    for section, options in sections:
+        f.write('[%s]\n' % section)
+        for option, value in options:
+            if value is not None:
+                f.write('%s=%s\n' % (option, value))
+        f.write('\n')
+    f.close()
+
+
+def runStage(args, log_file):
+    """
+    Run a stage in a child process. Returns the wall time and peak memory
+    (in kilobytes) of the child process.
+    """
+    out = open(log_file, 'a')
+    t0 = time.time()
+    process = subprocess.Popen([ sys.executable, '-W', 'ignore' ] + args, stdout=out, stderr=subprocess.STDOUT)
+    # wait4 gives the resource usage of the child alone (worker processes it forks are not included)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.time() - t0
+    out.close()
+    if status != 0:
+        print 'Stage %s exited with status %i, see %s' % (os.path.basename(args[0]), status >> 8, log_file)
+    return wall_time, rusage.ru_maxrss
+
+
+def benchmarkLRMS(lrms, options, work_dir, server, results):
+    lrms_dir = os.path.join(work_dir, lrms)
+    spool_dir = os.path.join(lrms_dir, 'spool')
+    log_dir = os.path.join(spool_dir, 'usagerecords')
+    user_map_file = os.path.join(lrms_dir, 'usermap')
+    vo_map_file = os.path.join(lrms_dir, 'vomap')
+    log_file = os.path.join(lrms_dir, 'benchmark.log')
+
+    t0 = time.time()
+    jobs = LOG_WRITERS[lrms](os.path.join(lrms_dir, lrms), options.jobs_per_day, options.days, options.shapes)
+    synthetic.writeMappings(user_map_file, vo_map_file)
+    print '%s: wrote %i jobs in %i logs (%.1f s)' % (lrms, jobs, options.days, time.time() - t0)
+
+    generator_config = os.path.join(lrms_dir, 'lrmsurgen.conf')
+    writeConfig(generator_config, [
+        ('common', [ ('hostname', 'ce.example.org'), ('logdir', log_dir), ('statedir', spool_dir),
+                     ('usermap', user_map_file), ('vomap', vo_map_file), ('logfile', log_file),
+                     ('spool', options.spool), ('workers', options.workers),
+                     ('batch_records', options.batch_records or None) ]),
+        (lrms,     [ ('spooldir', os.path.join(lrms_dir, lrms)) ]),
+    ])
+    wall_time, max_rss = runStage([ GENERATOR, '-c', generator_config ], log_file)
+    records = len(spool.SpoolReader(log_dir).scan())
+    results.append( ('%s generator' % lrms, records, wall_time, max_rss) )
+
+    registrant_config = os.path.join(lrms_dir, 'registrant.conf')
+    writeConfig(registrant_config, [
+        ('common', [ ('logdir', log_dir), ('x509_user_cert', options.certificate),
+                     ('x509_user_key', options.key), ('x509_cert_dir', options.ca_dir) ]),
+        ('logger', [ ('log_all', server.getURL()), ('compress', options.compress or None) ]),
+    ])
+    server.reset()
+    wall_time, max_rss = runStage([ REGISTRANT, '-s', '-c', registrant_config ], log_file)
+    results.append( ('%s registrant' % lrms, server.records, wall_time, max_rss) )
+    if server.errors:
+        print '%s: %i uploads failed by the SGAS stand-in' % (lrms, server.errors)
+
+
+def main():
+    options, args = getParser().parse_args()
+
+    server = sgas_server.SGASServer(options.port, options.latency, options.error_rate, options.certificate, options.key)
+    server.start()
+
+    work_dir = tempfile.mkdtemp(prefix='lrmsurgen-benchmark-')
+    results = []
+    try:
+        for lrms in options.lrms.split(','):
+            benchmarkLRMS(lrms.strip(), options, work_dir, server, results)
+    finally:
+        server.shutdown()
+        if options.keep:
+            print 'Benchmark files kept in %s' % work_dir
+        else:
+            shutil.rmtree(work_dir)
+
+    print
+    print '%-20s %10s %12s %12s %10s' % ('Stage', 'Records', 'Records/sec', 'Peak memory', 'Wall time')
+    for stage, records, wall_time, max_rss in results:
+        print '%-20s %10i %12.0f %9.1f MB %8.2f s' % (stage, records, records / wall_time, max_rss / 1024.0, wall_time)
+
+
+
+if __name__ == '__main__':
+    main()
+
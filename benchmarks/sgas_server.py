@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Local stand-in for an SGAS service, for the benchmarks.
+#
+# Serves the service document (GET on the service path) pointing to the
+# registration (insert) endpoint, and accepts usage record uploads (POST on
+# the registration path), plain or gzip compressed. Uploads can be delayed
+# (latency, in seconds) and answered with 503 at a given error rate. Served
+# over HTTPS if a certificate and key is given.
+#
+# Usage: python benchmarks/sgas_server.py [port] [latency] [error rate] [certificate key]
+#
+# Module for the LRMS UR Generator module.
+
+import re
+import sys
+import gzip
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+
+DEFAULT_PORT = 6180
+
+SERVICE_PATH      = '/sgas'
+REGISTRATION_PATH = '/sgas/ur'
+
+SERVICE_DOCUMENT = '<services><service><name>Registration</name><href>%s</href></service></services>' % REGISTRATION_PATH
+
+RECORD_END = re.compile('</(\w+:)?JobUsageRecord>')
+
+
+
+class SGASRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def sendResponse(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        if self.path.rstrip('/') != SERVICE_PATH:
+            self.sendResponse(404)
+            return
+        self.sendResponse(200, SERVICE_DOCUMENT)
+
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != REGISTRATION_PATH:
+            self.sendResponse(404)
+            return
+
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.count(errors=1)
+            self.sendResponse(503, 'Service unavailable (benchmark error rate)')
+            return
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        server.count(len(RECORD_END.findall(data)), len(data))
+        self.sendResponse(200)
+
+
+
+class SGASServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DEFAULT_PORT, latency=0, error_rate=0, certificate=None, key=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), SGASRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(42)
+        self.lock = threading.Lock()
+        self.scheme = 'http'
+        if certificate is not None:
+            import ssl
+            self.socket = ssl.wrap_socket(self.socket, keyfile=key, certfile=certificate, server_side=True)
+            self.scheme = 'https'
+        self.reset()
+
+
+    def getURL(self):
+        return '%s://127.0.0.1:%i%s' % (self.scheme, self.server_address[1], SERVICE_PATH)
+
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.records = 0
+            self.uploads = 0
+            self.upload_bytes = 0
+            self.errors = 0
+        finally:
+            self.lock.release()
+
+
+    def count(self, records=0, upload_bytes=0, errors=0):
+        self.lock.acquire()
+        try:
+            self.records += records
+            self.upload_bytes += upload_bytes
+            self.errors += errors
+            if not errors:
+                self.uploads += 1
+        finally:
+            self.lock.release()
+
+
+    def start(self):
+        """
+        Serve requests in a background thread.
+        """
+        t = threading.Thread(target=self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+
+
+def main():
+    port, latency, error_rate, certificate, key = DEFAULT_PORT, 0, 0, None, None
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        error_rate = float(sys.argv[3])
+    if len(sys.argv) > 5:
+        certificate, key = sys.argv[4:6]
+
+    server = SGASServer(port, latency, error_rate, certificate, key)
+    print 'Serving %s (latency %.3f s, error rate %.2f)' % (server.getURL(), latency, error_rate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# Synthetic LRMS logs for the benchmarks.
+#
+# Writes Maui workload traces (stats/<date>, 44 fields per job) and Torque
+# accounting logs (server_priv/accounting/<date>, Q, S and E records per job)
+# in the layout of the Maui and Torque spool directories, along with a user
+# and vo map covering the users of the jobs. The logs are spread over the
+# last days, ending today, so the generator picks them up without a state
+# file.
+#
+# Job shapes are given as nodes:ppn pairs, e.g. "1:1,1:8,2:4,4:8".
+#
+# Usage: python benchmarks/synthetic.py maui|torque directory [jobs per day] [days] [shapes]
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lrmsurgen import maui, torque
+
+
+DEFAULT_JOBS_PER_DAY = 10000
+DEFAULT_DAYS         = 5
+DEFAULT_SHAPES       = '1:1,1:8,2:4,4:8'
+DEFAULT_USERS        = 40
+DEFAULT_NODES        = 64
+
+QUEUES = [ 'grid', 'short', 'long' ]
+
+DAY = 24 * 60 * 60
+
+
+
+def parseShapes(shapes):
+    """
+    Parse a "nodes:ppn,..." string into a list of (nodes, ppn) tuples.
+    """
+    parsed = []
+    for shape in shapes.split(','):
+        nodes, ppn = shape.strip().split(':')
+        parsed.append( (int(nodes), int(ppn)) )
+    return parsed
+
+
+def getDays(days, now=None):
+    """
+    Returns the start of the last days (UTC), oldest first, ending with today.
+    """
+    if now is None:
+        now = time.time()
+    today = int(now) - int(now) % DAY
+    return [ today - d * DAY for d in range(days - 1, -1, -1) ]
+
+
+def createJobs(day_start, jobs, shapes, rnd, job_id):
+    """
+    Create job descriptions for a day, ordered by end time. Returns the jobs
+    and the next job id.
+    """
+    result = []
+    for end in sorted([ day_start + rnd.randint(0, DAY - 1) for _ in xrange(jobs) ]):
+        nodes, ppn = rnd.choice(shapes)
+        walltime = rnd.randint(60, 2 * DAY)
+        start = end - walltime
+        submit = start - rnd.randint(0, 3600)
+        hosts = [ 'n%03i' % h for h in rnd.sample(xrange(DEFAULT_NODES), min(nodes, DEFAULT_NODES)) ]
+        job = {
+            'id'       : job_id,
+            'user'     : 'user%02i' % rnd.randint(0, DEFAULT_USERS - 1),
+            'queue'    : rnd.choice(QUEUES),
+            'submit'   : submit,
+            'start'    : start,
+            'end'      : end,
+            'nodes'    : nodes,
+            'ppn'      : ppn,
+            'hosts'    : hosts,
+            'walltime' : walltime,
+            'cputime'  : int(walltime * nodes * ppn * rnd.random()),
+            'account'  : rnd.choice([ '[NONE]', '[NONE]', 'project%i' % rnd.randint(0, 9) ]),
+            'state'    : rnd.choice([ 'Completed' ] * 9 + [ 'Removed' ]),
+        }
+        result.append(job)
+        job_id += 1
+    return result, job_id
+
+
+def writeMauiTraces(maui_spool_dir, jobs_per_day=DEFAULT_JOBS_PER_DAY, days=DEFAULT_DAYS,
+                    shapes=DEFAULT_SHAPES, seed=42, now=None):
+    """
+    Write Maui workload traces into a Maui spool directory. Returns the number
+    of jobs written.
+    """
+    rnd = random.Random(seed)
+    shapes = parseShapes(shapes)
+    stats_dir = os.path.join(maui_spool_dir, maui.STATS_DIR)
+    if not os.path.exists(stats_dir):
+        os.makedirs(stats_dir)
+    f = open(os.path.join(maui_spool_dir, maui.MAUI_CFG_FILE), 'w')
+    f.write('SERVERHOST            maui.example.org\n')
+    f.close()
+
+    job_id = 100000
+    written = 0
+    for day_start in getDays(days, now):
+        jobs, job_id = createJobs(day_start, jobs_per_day, shapes, rnd, job_id)
+        f = open(os.path.join(stats_dir, time.strftime(maui.MAUI_DATE_FORMAT, time.gmtime(day_start))), 'w')
+        f.write('VERSION 230\n')
+        for job in jobs:
+            tasks = job['nodes'] * job['ppn']
+            fields = [ str(job['id']), str(job['nodes']), str(tasks), job['user'], 'users', '172800',
+                       job['state'], '[%s:1]' % job['queue'], str(job['submit']), str(job['start']),
+                       str(job['start']), str(job['end']), '[NONE]', '[NONE]', '[NONE]', '>=', '0', '>=', '0',
+                       '[NONE]', str(job['submit']), str(tasks), str(job['ppn']), 'DEFAULT', 'RESTARTABLE',
+                       job['account'], '[NONE]', '[NONE]', '0', '%.2f' % job['cputime'], 'DEFAULT', '1',
+                       '0', '0', '0', '0', '0', ':'.join(job['hosts']), 'PBS', '[NONE]', '[NONE]', '[NONE]',
+                       '[NONE]', '[NONE]' ]
+            assert len(fields) == 44
+            f.write(' '.join(fields) + '\n')
+        f.close()
+        written += len(jobs)
+    return written
+
+
+def formatSeconds(seconds):
+    return '%02i:%02i:%02i' % (seconds / 3600, seconds % 3600 / 60, seconds % 60)
+
+
+def writeTorqueLogs(torque_spool_dir, jobs_per_day=DEFAULT_JOBS_PER_DAY, days=DEFAULT_DAYS,
+                    shapes=DEFAULT_SHAPES, seed=42, now=None):
+    """
+    Write Torque accounting logs into a Torque spool directory. Returns the
+    number of jobs written.
+    """
+    rnd = random.Random(seed)
+    shapes = parseShapes(shapes)
+    accounting_dir = os.path.join(torque_spool_dir, 'server_priv', 'accounting')
+    if not os.path.exists(accounting_dir):
+        os.makedirs(accounting_dir)
+
+    job_id = 100000
+    written = 0
+    for day_start in getDays(days, now):
+        jobs, job_id = createJobs(day_start, jobs_per_day, shapes, rnd, job_id)
+        f = open(os.path.join(accounting_dir, time.strftime(torque.TORQUE_DATE_FORMAT, time.gmtime(day_start))), 'w')
+        for job in jobs:
+            ts = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(job['end']))
+            job_name = '%i.torque.example.org' % job['id']
+            nodes = '%i:ppn=%i' % (job['nodes'], job['ppn'])
+            exec_host = '+'.join([ '%s/%i' % (host, cpu) for host in job['hosts'] for cpu in range(job['ppn']) ])
+            common = 'user=%s group=users jobname=job queue=%s ctime=%i qtime=%i etime=%i start=%i' % \
+                     (job['user'], job['queue'], job['submit'], job['submit'], job['submit'], job['start'])
+            f.write('%s;Q;%s;queue=%s\n' % (ts, job_name, job['queue']))
+            f.write('%s;S;%s;%s exec_host=%s Resource_List.nodes=%s\n' % (ts, job_name, common, exec_host, nodes))
+            f.write('%s;E;%s;%s owner=%s@login.example.org exec_host=%s Resource_List.neednodes=%s '
+                    'Resource_List.nodes=%s Resource_List.walltime=48:00:00 session=4242 end=%i Exit_status=0 '
+                    'resources_used.cput=%s resources_used.mem=1024kb resources_used.vmem=4096kb '
+                    'resources_used.walltime=%s\n' % \
+                    (ts, job_name, common, job['user'], exec_host, nodes, nodes, job['end'],
+                     formatSeconds(job['cputime']), formatSeconds(job['walltime'])))
+        f.close()
+        written += len(jobs)
+    return written
+
+
+def writeMappings(user_map_file, vo_map_file, users=DEFAULT_USERS):
+    """
+    Write a user map and a vo map for the synthetic users, every other user
+    is mapped to a vo.
+    """
+    f = open(user_map_file, 'w')
+    for i in range(users):
+        f.write('user%02i "/O=Grid/O=Example/CN=User %i"\n' % (i, i))
+    f.close()
+    f = open(vo_map_file, 'w')
+    for i in range(0, users, 2):
+        f.write('user%02i "vo%i.example.org"\n' % (i, i % 3))
+    f.close()
+
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('maui', 'torque'):
+        print 'Usage: %s maui|torque directory [jobs per day] [days] [shapes]' % sys.argv[0]
+        sys.exit(1)
+
+    lrms, directory = sys.argv[1:3]
+    jobs_per_day, days, shapes = DEFAULT_JOBS_PER_DAY, DEFAULT_DAYS, DEFAULT_SHAPES
+    if len(sys.argv) > 3:
+        jobs_per_day = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        days = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        shapes = sys.argv[5]
+
+    if lrms == 'maui':
+        written = writeMauiTraces(directory, jobs_per_day, days, shapes)
+    else:
+        written = writeTorqueLogs(directory, jobs_per_day, days, shapes)
+    print 'Wrote %i jobs to %s' % (written, directory)
+
+
+
+if __name__ == '__main__':
+    main()
+
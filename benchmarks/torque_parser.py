@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Benchmark of the Torque accounting log parsers.
+#
+# Writes a synthetic accounting log, checks that the block parser produces
+# the same entries as the line parser (for the fields used in usage records)
+# and reports records/sec for both.
+#
+# Usage: python benchmarks/torque_parser.py [number of jobs]
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lrmsurgen import torque
+
+
+DEFAULT_JOBS = 200000
+
+PROJECTED_KEYS = [ 'entrytype', 'jobid', 'user', 'queue', 'ctime', 'start', 'end', 'exec_host',
+                   'Resource_List.nodes', 'resources_used.cput', 'resources_used.walltime' ]
+
+
+
+def writeAccountingLog(filename, jobs):
+    """
+    Write a synthetic accounting log, with a queue, start and end record per job.
+    """
+    rnd = random.Random(42)
+    f = open(filename, 'w')
+    t = 1280000000
+    for job in xrange(jobs):
+        t += rnd.randint(0, 5)
+        ts = time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(t))
+        job_id = '%i.torque.example.org' % (100000 + job)
+        user = 'user%02i' % rnd.randint(0, 40)
+        nodes = rnd.choice(['1', '1:ppn=8', '2:ppn=4', '4:ppn=8+n17'])
+        walltime = rnd.randint(60, 86400)
+        start = t - walltime
+        ctime = start - rnd.randint(0, 3600)
+        exec_host = '+'.join([ 'n%02i/%i' % (rnd.randint(0, 64), c) for c in range(rnd.randint(1, 8)) ])
+        f.write('%s;Q;%s;queue=grid\n' % (ts, job_id))
+        f.write('%s;S;%s;user=%s group=users jobname=job queue=grid ctime=%i qtime=%i etime=%i start=%i '
+                'exec_host=%s Resource_List.nodes=%s\n' % (ts, job_id, user, ctime, ctime, ctime, start, exec_host, nodes))
+        f.write('%s;E;%s;user=%s group=users jobname=job queue=grid ctime=%i qtime=%i etime=%i start=%i '
+                'owner=%s@login.example.org exec_host=%s Resource_List.neednodes=%s Resource_List.nodes=%s '
+                'Resource_List.walltime=24:00:00 session=4242 end=%i Exit_status=0 resources_used.cput=%s '
+                'resources_used.mem=1024kb resources_used.vmem=4096kb resources_used.walltime=%s\n' % \
+                (ts, job_id, user, ctime, ctime, ctime, start, user, exec_host, nodes, nodes, t,
+                 formatSeconds(rnd.randint(0, walltime)), formatSeconds(walltime)))
+    f.close()
+
+
+def formatSeconds(seconds):
+    return '%02i:%02i:%02i' % (seconds / 3600, seconds % 3600 / 60, seconds % 60)
+
+
+def readEntries(parser):
+    entries = []
+    while True:
+        entry = parser.getNextLogEntry()
+        if entry is None:
+            break
+        entries.append(entry)
+    return entries
+
+
+def timeParser(parser_class, filename):
+    t0 = time.time()
+    entries = readEntries(parser_class(filename))
+    return entries, time.time() - t0
+
+
+def main():
+    jobs = DEFAULT_JOBS
+    if len(sys.argv) > 1:
+        jobs = int(sys.argv[1])
+
+    fd, filename = tempfile.mkstemp(prefix='torque-accounting-')
+    os.close(fd)
+    try:
+        writeAccountingLog(filename, jobs)
+        print 'Accounting log: %i jobs, %.1f MB' % (jobs, os.path.getsize(filename) / 1048576.0)
+
+        line_entries, line_time = timeParser(torque.TorqueLogParser, filename)
+        block_entries, block_time = timeParser(torque.TorqueBlockLogParser, filename)
+
+        assert len(line_entries) == len(block_entries), 'Parsers returned different number of entries'
+        for le, be in zip(line_entries, block_entries):
+            for key in PROJECTED_KEYS:
+                assert le[key] == be[key], 'Entry %s differs for %s: %s / %s' % (le['jobid'], key, le[key], be[key])
+
+        print 'TorqueLogParser      : %8.0f records/sec (%.2f s)' % (len(line_entries) / line_time, line_time)
+        print 'TorqueBlockLogParser : %8.0f records/sec (%.2f s)' % (len(block_entries) / block_time, block_time)
+        print 'Speedup              : %8.1fx' % (line_time / block_time)
+    finally:
+        os.unlink(filename)
+
+
+
+if __name__ == '__main__':
+    main()
+
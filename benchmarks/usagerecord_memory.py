@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# Benchmark of the memory used by usage records held in memory.
+#
+# Creates usage records (the same mix as usagerecord_serializer.py) and
+# reports the growth of the resident memory per record, for a list of
+# records and for a UsageRecordBatch. The batch is also serialized, and the
+# size of the UsageRecords document is reported.
+#
+# Usage: python benchmarks/usagerecord_memory.py [number of records]
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import gc
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+
+from lrmsurgen import usagerecord
+import usagerecord_serializer
+
+
+DEFAULT_RECORDS = 200000
+
+
+
+def getResidentMemory():
+    # second field of statm is the resident set size, in pages
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(create, count):
+    """
+    Returns the result of create() and the resident memory growth per
+    record while creating it.
+    """
+    gc.collect()
+    before = getResidentMemory()
+    result = create()
+    gc.collect()
+    return result, float(getResidentMemory() - before) / count
+
+
+def main():
+    records = DEFAULT_RECORDS
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+
+    urs, list_size = measure(lambda : usagerecord_serializer.createUsageRecords(records), records)
+    del urs
+
+    batch, batch_size = measure(lambda : usagerecord.UsageRecordBatch(usagerecord_serializer.createUsageRecords(records)), records)
+    document = batch.toXML()
+
+    print 'Records        : %i' % records
+    print 'List of records: %6.0f bytes/record' % list_size
+    print 'Record batch   : %6.0f bytes/record' % batch_size
+    print 'Batch document : %6.0f bytes/record' % (float(len(document)) / records)
+
+
+
+if __name__ == '__main__':
+    main()
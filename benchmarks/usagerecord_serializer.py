@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Benchmark of usage record serialization.
+#
+# Checks that the template serializer (UsageRecord.toXML) gives the same
+# documents as serializing the element tree from UsageRecord.generateTree,
+# and reports records/sec for both.
+#
+# Usage: python benchmarks/usagerecord_serializer.py [number of records]
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import re
+import sys
+import time
+import random
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lrmsurgen import usagerecord
+from lrmsurgen.usagerecord import ET
+
+
+DEFAULT_RECORDS = 50000
+
+CREATE_TIME_ATTRIBUTE = re.compile('createTime="[^"]*"')
+
+
+
+def createUsageRecords(count):
+    """
+    Create usage records with a mix of the optional fields set.
+    """
+    rnd = random.Random(42)
+    urs = []
+    for i in xrange(count):
+        ur = usagerecord.UsageRecord()
+        ur.record_id = 'host.example.org:%i.torque.example.org' % i
+        ur.local_job_id = '%i.torque.example.org' % i
+        ur.global_job_id = ur.record_id
+        ur.local_user_id = 'user%02i' % rnd.randint(0, 40)
+        if rnd.random() < 0.7:
+            ur.global_user_name = '/O=Grid/O=Example/CN=User %s & <co>' % ur.local_user_id
+        if rnd.random() < 0.5:
+            ur.vo_info.append(usagerecord.VOInformation(name='vo%i.example.org' % rnd.randint(0, 5), type_='lrmsurgen-vomap'))
+        if rnd.random() < 0.1:
+            voi = usagerecord.VOInformation(name='atlas', type_='voms', issuer='/CN=voms.example.org')
+            voi.attributes.append( ('/atlas', 'production', None) )
+            ur.vo_info.append(voi)
+        ur.machine_name = 'host.example.org'
+        ur.queue = rnd.choice(['grid', 'short', 'long', ''])
+        ur.processors = rnd.randint(1, 64)
+        ur.node_count = rnd.randint(1, 8)
+        ur.host = ','.join([ 'n%02i' % n for n in range(ur.node_count) ])
+        if rnd.random() < 0.5:
+            ur.project_name = 'project%i' % rnd.randint(0, 9)
+        ur.submit_time = usagerecord.epoch2isoTime(1280000000 + i)
+        ur.start_time = usagerecord.epoch2isoTime(1280000100 + i)
+        ur.end_time = usagerecord.epoch2isoTime(1280003600 + i)
+        ur.wall_duration = rnd.randint(0, 86400)
+        ur.cpu_duration = rnd.random() * 86400
+        if rnd.random() < 0.1:
+            ur.exit_code = rnd.randint(0, 255)
+            ur.runtime_environments.append('APPS/BIO/BLAST-2.2')
+        urs.append(ur)
+    return urs
+
+
+def serializeTree(ur):
+    f = StringIO()
+    f.write(usagerecord.XML_HEADER)
+    ur.generateTree().write(f, encoding='utf-8')
+    return f.getvalue()
+
+
+def canonical(element):
+    attrib = dict(element.attrib)
+    attrib.pop(str(usagerecord.CREATE_TIME), None)
+    return (element.tag, sorted(attrib.items()), (element.text or '').strip(), [ canonical(e) for e in element ])
+
+
+def timeSerializer(serializer, urs):
+    t0 = time.time()
+    for ur in urs:
+        serializer(ur)
+    return time.time() - t0
+
+
+def main():
+    records = DEFAULT_RECORDS
+    if len(sys.argv) > 1:
+        records = int(sys.argv[1])
+
+    urs = createUsageRecords(records)
+
+    identical = 0
+    for ur in urs:
+        tree_xml = serializeTree(ur)
+        template_xml = ur.toXML()
+        assert canonical(ET.fromstring(tree_xml)) == canonical(ET.fromstring(template_xml)), \
+            'Serialization differs for %s:\n%s\n%s' % (ur.record_id, tree_xml, template_xml)
+        if CREATE_TIME_ATTRIBUTE.sub('', tree_xml) == CREATE_TIME_ATTRIBUTE.sub('', template_xml):
+            identical += 1
+    print 'Equivalent documents: %i, of which byte identical (except createTime): %i' % (len(urs), identical)
+
+    tree_time = timeSerializer(serializeTree, urs)
+    template_time = timeSerializer(usagerecord.UsageRecord.toXML, urs)
+
+    print 'ElementTree : %8.0f records/sec (%.2f s)' % (len(urs) / tree_time, tree_time)
+    print 'Templates   : %8.0f records/sec (%.2f s)' % (len(urs) / template_time, template_time)
+    print 'Speedup     : %8.1fx' % (tree_time / template_time)
+
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,244 @@
+#
+# Usage aggregation module.
+#
+# Module for the LRMS UR Generator module.
+#
+# Per-day totals of the usage records generated (jobs, wall and cpu time,
+# core hours), keyed by day, machine, user, VO, queue and project. The
+# totals are kept in an sqlite database in the state directory
+# (aggregates.db), and can be exported as CSV or as summary records without
+# reading the spool.
+#
+# Records are added to the totals in memory, and the totals are written to
+# the database when the generator state is committed (before the state
+# itself). Together with the totals, the offset of the last log entry added
+# is stored for each log file, and entries at or before it are not added
+# again, so records generated again after a crash are only counted once.
+
+import os
+import csv
+
+try:
+    import sqlite3
+except ImportError:
+    # Python 2.4 compatability
+    from pysqlite2 import dbapi2 as sqlite3
+
+try:
+    from xml.etree import ElementTree as ET
+except ImportError:
+    # Python 2.4 compatability
+    from elementtree import ElementTree as ET
+
+from lrmsurgen import config, usagerecord
+
+
+
+AGGREGATES_DATABASE = 'aggregates.db'
+
+KEY_COLUMNS   = ('day', 'machine_name', 'user', 'global_user_name', 'vo', 'queue', 'project_name')
+VALUE_COLUMNS = ('jobs', 'wall_seconds', 'cpu_seconds', 'core_seconds')
+
+# summary record elements (the usage record elements are used where they exist)
+SUMMARY_RECORDS = ET.QName("{%s}SummaryRecords" % usagerecord.LOGGER_NAMESPACE)
+SUMMARY_RECORD  = ET.QName("{%s}SummaryRecord"  % usagerecord.LOGGER_NAMESPACE)
+DAY             = ET.QName("{%s}Day"            % usagerecord.LOGGER_NAMESPACE)
+NUMBER_OF_JOBS  = ET.QName("{%s}NumberOfJobs"   % usagerecord.LOGGER_NAMESPACE)
+CORE_HOURS      = ET.QName("{%s}CoreHours"      % usagerecord.LOGGER_NAMESPACE)
+
+EXPORT_CSV = 'csv'
+EXPORT_XML = 'xml'
+
+
+
+def _connect(db_file):
+    db = sqlite3.connect(db_file)
+    db.text_factory = str
+    db.execute('CREATE TABLE IF NOT EXISTS aggregates (%s, %s, PRIMARY KEY (%s))' % \
+               (', '.join([ '%s TEXT NOT NULL' % c for c in KEY_COLUMNS ]),
+                ', '.join([ '%s REAL NOT NULL' % c for c in VALUE_COLUMNS ]),
+                ', '.join(KEY_COLUMNS)))
+    db.execute('CREATE TABLE IF NOT EXISTS positions (log_file TEXT PRIMARY KEY, line_offset INTEGER NOT NULL)')
+    db.commit()
+    return db
+
+
+
+def getRecordKey(ur):
+    """
+    Returns the aggregation key of a usage record. Missing values are empty
+    strings (they are part of the primary key in the database).
+    """
+    vo = ''
+    if ur.vo_info:
+        vo = ur.vo_info[0].name
+    return (ur.end_time[:10], ur.machine_name or '', ur.local_user_id or '', ur.global_user_name or '',
+            vo or '', ur.queue or '', ur.project_name or '')
+
+
+
+class Aggregator:
+    """
+    Per-day usage totals. The database is only opened when loading the log
+    file positions and when committing, so an Aggregator can be passed
+    between processes (the backlog workers).
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.totals = {}    # key -> [ jobs, wall seconds, cpu seconds, core seconds ], not committed
+        self.positions = {} # log file -> offset of the last entry added
+        self.pending = 0
+
+        db = _connect(db_file)
+        try:
+            for log_file, offset in db.execute('SELECT log_file, line_offset FROM positions'):
+                self.positions[log_file] = offset
+        finally:
+            db.close()
+
+
+    def add(self, ur, log_file, offset):
+        """
+        Add a usage record, generated from the log entry at offset in
+        log_file. Returns False if the entry has already been added.
+        """
+        if offset <= self.positions.get(log_file, -1):
+            return False
+        self.positions[log_file] = offset
+
+        key = getRecordKey(ur)
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = [ 0, 0.0, 0.0, 0.0 ]
+        wall_time = ur.wall_duration or 0
+        totals[0] += 1
+        totals[1] += wall_time
+        totals[2] += ur.cpu_duration or 0
+        totals[3] += wall_time * (ur.processors or 1)
+        self.pending += 1
+        return True
+
+
+    def merge(self, other):
+        """
+        Add the uncommitted totals of another Aggregator (e.g., from a worker
+        process) to this one.
+        """
+        for key, values in other.totals.items():
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = [ 0, 0.0, 0.0, 0.0 ]
+            for i in range(len(values)):
+                totals[i] += values[i]
+        for log_file, offset in other.positions.items():
+            self.positions[log_file] = max(offset, self.positions.get(log_file, -1))
+        self.pending += other.pending
+
+
+    def commit(self):
+        """
+        Write the totals and log file positions to the database, in one
+        transaction.
+        """
+        if not self.pending:
+            return
+        db = _connect(self.db_file)
+        try:
+            rows = [ key + tuple(values) for key, values in self.totals.items() ]
+            db.executemany('INSERT OR IGNORE INTO aggregates VALUES (%s)' % \
+                           ', '.join([ '?' ] * len(KEY_COLUMNS) + [ '0' ] * len(VALUE_COLUMNS)),
+                           [ row[:len(KEY_COLUMNS)] for row in rows ])
+            db.executemany('UPDATE aggregates SET %s WHERE %s' % \
+                           (', '.join([ '%s = %s + ?' % (c, c) for c in VALUE_COLUMNS ]),
+                            ' AND '.join([ '%s = ?' % c for c in KEY_COLUMNS ])),
+                           [ row[len(KEY_COLUMNS):] + row[:len(KEY_COLUMNS)] for row in rows ])
+            db.executemany('INSERT OR REPLACE INTO positions VALUES (?, ?)', self.positions.items())
+            db.commit()
+        finally:
+            db.close()
+        self.totals = {}
+        self.pending = 0
+
+
+
+def getDatabaseLocation(cfg):
+    state_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.STATEDIR, config.DEFAULT_STATEDIR)
+    return os.path.join(state_dir, AGGREGATES_DATABASE)
+
+
+def isEnabled(cfg):
+    value = config.getConfigValue(cfg, config.SECTION_COMMON, config.AGGREGATE, config.DEFAULT_AGGREGATE)
+    return str(value).lower() in ('true', 'yes', '1')
+
+
+def createAggregator(cfg):
+    """
+    Returns the Aggregator for the configured state directory, or None if
+    aggregation is not enabled.
+    """
+    if not isEnabled(cfg):
+        return None
+    db_file = getDatabaseLocation(cfg)
+    if not os.path.exists(os.path.dirname(db_file)):
+        os.makedirs(os.path.dirname(db_file))
+    return Aggregator(db_file)
+
+
+def readAggregates(db_file):
+    """
+    Returns the totals in the database as a list of dicts, ordered by key.
+    """
+    db = _connect(db_file)
+    try:
+        columns = KEY_COLUMNS + VALUE_COLUMNS
+        rows = db.execute('SELECT %s FROM aggregates ORDER BY %s' % (', '.join(columns), ', '.join(KEY_COLUMNS)))
+        return [ dict(zip(columns, row)) for row in rows ]
+    finally:
+        db.close()
+
+
+def writeCSV(aggregates, f):
+    writer = csv.writer(f)
+    writer.writerow(KEY_COLUMNS + ('jobs', 'wall_hours', 'cpu_hours', 'core_hours'))
+    for a in aggregates:
+        writer.writerow([ a[c] for c in KEY_COLUMNS ] +
+                        [ int(a['jobs']), '%.3f' % (a['wall_seconds'] / 3600),
+                          '%.3f' % (a['cpu_seconds'] / 3600), '%.3f' % (a['core_seconds'] / 3600) ])
+
+
+def createSummaryRecords(aggregates):
+    """
+    Returns the totals as an XML document of summary records, one for each
+    day, machine, user, VO, queue and project.
+    """
+    records = ET.Element(SUMMARY_RECORDS)
+    for a in aggregates:
+        record = ET.SubElement(records, SUMMARY_RECORD)
+        ET.SubElement(record, DAY).text = a['day']
+        for column, element in ( ('machine_name',     usagerecord.MACHINE_NAME),
+                                 ('user',             usagerecord.LOCAL_USER_ID),
+                                 ('global_user_name', usagerecord.GLOBAL_USER_NAME),
+                                 ('vo',               usagerecord.VO_NAME),
+                                 ('queue',            usagerecord.QUEUE),
+                                 ('project_name',     usagerecord.PROJECT_NAME) ):
+            if a[column]:
+                ET.SubElement(record, element).text = a[column].decode('utf-8', 'replace')
+        ET.SubElement(record, NUMBER_OF_JOBS).text = str(int(a['jobs']))
+        ET.SubElement(record, usagerecord.WALL_DURATION).text = 'PT%fS' % a['wall_seconds']
+        ET.SubElement(record, usagerecord.CPU_DURATION).text = 'PT%fS' % a['cpu_seconds']
+        ET.SubElement(record, CORE_HOURS).text = '%.3f' % (a['core_seconds'] / 3600)
+    return usagerecord.XML_HEADER + ET.tostring(records) + '\n'
+
+
+def exportAggregates(cfg, format, f):
+    """
+    Write the totals to f, as CSV or summary records (EXPORT_CSV or
+    EXPORT_XML). Raises ValueError for other formats.
+    """
+    if not format in (EXPORT_CSV, EXPORT_XML):
+        raise ValueError('Invalid export format: %s (use %s or %s)' % (format, EXPORT_CSV, EXPORT_XML))
+    aggregates = readAggregates(getDatabaseLocation(cfg))
+    if format == EXPORT_CSV:
+        writeCSV(aggregates, f)
+    else:
+        f.write(createSummaryRecords(aggregates))
@@ -0,0 +1,153 @@
+#
+# Columnar computation module.
+#
+# Module for the LRMS UR Generator module.
+#
+# Helpers for creating usage records from a batch of log entries at a time
+# (the batch_records option). The numeric fields of the entries are converted
+# into columns, and the derived fields (wall time, cpu time, core counts,
+# timestamps) are computed for the whole column at once. With numpy the
+# columns are arrays and the computations are vectorized, without it the
+# columns are lists. Either way the values are the same as those computed
+# for each record on its own (the arithmetic is done on 64 bit integers and
+# doubles in both cases).
+
+import time
+
+try:
+    import numpy
+    if not hasattr(numpy, 'datetime_as_string'):
+        numpy = None # numpy before 1.7, without datetime64
+except ImportError:
+    numpy = None
+
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# usagerecord.ISO_TIME_FORMAT, split into the date and the time of day
+ISO_DATE_FORMAT = '%Y-%m-%dT'
+
+# time of day strings, for each minute of the day and second of the minute
+_HOURS_MINUTES = [ '%02i:%02i:' % divmod(m, 60) for m in range(24 * 60) ]
+_SECONDS       = [ '%02iZ' % s for s in range(60) ]
+
+
+
+def intColumn(values):
+    """
+    Returns a column of the integer values of strings.
+    """
+    column = map(int, values)
+    if numpy is not None:
+        return numpy.array(column, dtype=numpy.int64)
+    return column
+
+
+def floatColumn(values):
+    """
+    Returns a column of the float values of strings.
+    """
+    column = map(float, values)
+    if numpy is not None:
+        return numpy.array(column, dtype=numpy.float64)
+    return column
+
+
+def durationColumn(values):
+    """
+    Returns a column of the seconds of HH:MM:SS strings (see torque.getSeconds).
+    """
+    fields = [ value.split(':') for value in values ]
+    for f in fields:
+        if len(f) != 3:
+            raise ValueError('Invalid duration: %s' % ':'.join(f))
+    hours   = intColumn([ f[0] for f in fields ])
+    minutes = intColumn([ f[1] for f in fields ])
+    seconds = intColumn([ f[2] for f in fields ])
+    if numpy is not None:
+        return hours * 3600 + minutes * 60 + seconds
+    return [ h*3600 + m*60 + s for h, m, s in zip(hours, minutes, seconds) ]
+
+
+def subtract(a, b):
+    if numpy is not None:
+        return a - b
+    return [ x - y for x, y in zip(a, b) ]
+
+
+def multiply(a, b):
+    if numpy is not None:
+        return a * b
+    return [ x * y for x, y in zip(a, b) ]
+
+
+def correctCPUTimes(utilized_cpus, wall_times, alo_tasks):
+    """
+    Divides the cpu times which are higher than wall time * tasks by the
+    number of tasks (see maui.createUsageRecord for why).
+    """
+    if numpy is None:
+        corrected = []
+        for utilized_cpu, wall_time, tasks in zip(utilized_cpus, wall_times, alo_tasks):
+            if utilized_cpu > wall_time * tasks:
+                utilized_cpu /= tasks
+            corrected.append(utilized_cpu)
+        return corrected
+
+    excessive = utilized_cpus > wall_times * alo_tasks
+    if (excessive & (alo_tasks == 0)).any():
+        raise ZeroDivisionError('float division') # as for a single record
+    old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        divided = utilized_cpus / alo_tasks
+    finally:
+        numpy.seterr(**old_settings)
+    return numpy.where(excessive, divided, utilized_cpus)
+
+
+def mapUnique(f, values):
+    """
+    Returns the list of f(value) for the values, calling f once for each
+    distinct value (e.g. getCoreCount, as there are few distinct node specs).
+    """
+    results = {}
+    column = []
+    for value in values:
+        try:
+            column.append(results[value])
+        except KeyError:
+            result = results[value] = f(value)
+            column.append(result)
+    return column
+
+
+def isoTimes(epoch_times):
+    """
+    Returns a list of the ISO time strings of a column of epoch times (as
+    usagerecord.epoch2isoTime).
+    """
+    if numpy is not None:
+        times = numpy.datetime_as_string(numpy.asarray(epoch_times, dtype=numpy.int64).astype('datetime64[s]'))
+        return [ str(t) + 'Z' for t in times.tolist() ]
+
+    # the date is formatted once for each day, the time of day is looked up
+    dates = {}
+    iso_times = []
+    for epoch_time in epoch_times:
+        day, seconds = divmod(epoch_time, SECONDS_PER_DAY)
+        date = dates.get(day)
+        if date is None:
+            date = dates[day] = time.strftime(ISO_DATE_FORMAT, time.gmtime(day * SECONDS_PER_DAY))
+        minutes, seconds = divmod(seconds, 60)
+        iso_times.append(date + _HOURS_MINUTES[minutes] + _SECONDS[seconds])
+    return iso_times
+
+
+def toList(column):
+    """
+    Returns the values of a column as a list of Python ints/floats.
+    """
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column.tolist()
+    return column
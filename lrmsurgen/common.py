@@ -8,9 +8,16 @@
 
 import os
 import time
+import zlib
 import datetime
 
-from lrmsurgen import config
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 and older, backlogs are processed serially
+    multiprocessing = None
+
+from lrmsurgen import config, profiling
 
 
 
@@ -27,6 +34,36 @@ def getIncrementalDate(date, date_format):
     return next_date
 
 
+def getBacklogDates(date, date_today, date_format):
+    """
+    Returns the dates from date up to, but not including, date_today.
+    """
+    dates = []
+    while time.strptime(date, date_format) < time.strptime(date_today, date_format):
+        dates.append(date)
+        date = getIncrementalDate(date, date_format)
+    return dates
+
+
+def getNextLogDate(log_dir, date, date_format):
+    """
+    Returns the date of the log file to follow after the one for date, or
+    None if the log file for date is still the current one. The LRMS only
+    creates a log file for a day with events, so dates without a log file are
+    skipped: this is the first later date with a log file (up to tomorrow, the
+    latest log file that can exist), or today, if the (UTC) day of date is
+    over and no later log file has been created yet.
+    """
+    today = time.strftime(date_format, time.gmtime())
+    day_after_tomorrow = getIncrementalDate(getIncrementalDate(today, date_format), date_format)
+    for later_date in getBacklogDates(getIncrementalDate(date, date_format), day_after_tomorrow, date_format):
+        if os.path.exists(os.path.join(log_dir, later_date)):
+            return later_date
+    if time.strptime(date, date_format) < time.strptime(today, date_format):
+        return today
+    return None
+
+
 def _getStateFileLocation(cfg):
     """
     Returns the location of state file
@@ -40,35 +77,194 @@ def _getStateFileLocation(cfg):
 def getGeneratorState(cfg, date_format):
     """
     Get state of where to the UR generation has reached in the log.
-    This is two string tuple containing the jobid and the log file.
+    This is a three tuple containing the jobid, the log file and a checkpoint
+    for the log entry (None if the state has no checkpoint).
     """
     state_file = _getStateFileLocation(cfg)
     if not os.path.exists(state_file):
         # no statefile -> we start from a couple of days back
         t_old = time.time() - 500000
-        return None, time.strftime(date_format, time.gmtime(t_old))
+        return None, time.strftime(date_format, time.gmtime(t_old)), None
 
     state_data = open(state_file).readline().strip() # state is only on the first line
-    job_id, date = state_data.split(' ', 2)
+    state_fields = state_data.split(' ')
+    job_id, date = state_fields[:2]
     if job_id == '-':
         job_id = None
-    return job_id, date
+
+    checkpoint = None
+    if len(state_fields) == 6: # older state files does not have a checkpoint
+        checkpoint = tuple([ int(f) for f in state_fields[2:] ])
+    return job_id, date, checkpoint
 
 
-def writeGeneratorState(cfg, job_id, log_file):
+def writeGeneratorState(cfg, job_id, log_file, checkpoint=None):
     """
     Write the state of where the logs have been parsed to.
-    This is a job id and date (log file and entry).
+    This is a job id and date (log file and entry), optionally followed by
+    a checkpoint of the log entry.
     """
     state_file = _getStateFileLocation(cfg)
     state_data = '%s %s' % (job_id or '-', log_file)
+    if checkpoint is not None:
+        state_data += ' %i %i %i %i' % checkpoint
 
     dirpath = os.path.dirname(state_file)
     if not os.path.exists(dirpath):
         os.makedirs(dirpath, mode=0750)
 
-    f = open(state_file, 'w')
+    # write to a temporary file and rename it in place, so a crash
+    # cannot leave an empty or half written state file behind
+    tmp_state_file = state_file + '.tmp'
+    f = open(tmp_state_file, 'w')
     f.write(state_data)
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.rename(tmp_state_file, state_file)
+
+
+
+class GeneratorStateWriter:
+    """
+    Group commit of the generator state.
+
+    The state is updated for every usage record written, but only committed
+    to disk every state_commit_records records or state_commit_interval
+    seconds, whichever comes first, and whenever commit is called explicitly
+    (typically at the end of a log file). After a crash the generator resumes
+    from the last commit, and at most the records written since then are
+    generated again. If a spool is given, it is flushed before the state is
+    committed, so the state never refers to records not written to disk.
+    Likewise the usage totals of the aggregator (if given) are committed
+    before the state. The time spent committing is added to run_metrics,
+    if given.
+    """
+    def __init__(self, cfg, ur_spool=None, run_metrics=None, aggregator=None):
+        self.cfg = cfg
+        self.ur_spool = ur_spool
+        self.run_metrics = run_metrics
+        self.aggregator = aggregator
+        self.commit_records = int(config.getConfigValue(cfg, config.SECTION_COMMON, config.STATE_COMMIT_RECORDS,
+                                                        config.DEFAULT_STATE_COMMIT_RECORDS))
+        self.commit_interval = float(config.getConfigValue(cfg, config.SECTION_COMMON, config.STATE_COMMIT_INTERVAL,
+                                                           config.DEFAULT_STATE_COMMIT_INTERVAL))
+        self.state = None
+        self.pending = 0
+        self.last_commit = time.time()
+
+
+    def update(self, job_id, log_file, checkpoint=None):
+        self.state = (job_id, log_file, checkpoint)
+        self.pending += 1
+        if self.pending >= self.commit_records or time.time() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+
+    def commit(self):
+        if self.pending:
+            t0 = time.time()
+            if self.ur_spool is not None:
+                self.ur_spool.flush()
+            if self.aggregator is not None:
+                self.aggregator.commit()
+            job_id, log_file, checkpoint = self.state
+            writeGeneratorState(self.cfg, job_id, log_file, checkpoint)
+            self.pending = 0
+            if self.run_metrics is not None:
+                self.run_metrics.inc('stage_seconds_total', time.time() - t0, stage='state')
+                self.run_metrics.inc('state_commits_total')
+        self.last_commit = time.time()
+
+
+
+def getLineChecksum(line):
+    """
+    Returns a checksum of a log line, used for fingerprinting checkpoints.
+    """
+    return zlib.crc32(line) & 0xffffffff
+
 
+def getCheckpoint(file_, offset, line):
+    """
+    Returns a checkpoint for a log line, which starts at the given offset in
+    the (open) file. The checkpoint is an (offset, inode, size, checksum) tuple,
+    where the inode, size and checksum is used to fingerprint the file.
+    """
+    st = os.fstat(file_.fileno())
+    return offset, st.st_ino, st.st_size, getLineChecksum(line)
+
+
+def seekCheckpoint(file_, checkpoint):
+    """
+    Positions the file just after the log line described by checkpoint and
+    returns the new offset. If the file does not match the fingerprint in the
+    checkpoint (rotated, truncated, rewritten), the file is rewound and None
+    is returned.
+    """
+    offset, inode, size, checksum = checkpoint
+
+    st = os.fstat(file_.fileno())
+    if st.st_ino == inode and st.st_size >= size:
+        file_.seek(offset)
+        line = file_.readline()
+        if line and getLineChecksum(line) == checksum:
+            return offset + len(line)
+
+    file_.seek(0)
+    return None
+
+
+
+def getWorkerCount(cfg):
+    """
+    Returns the number of worker processes to use for processing backlogs.
+    """
+    if multiprocessing is None:
+        return 1
+    return int(config.getConfigValue(cfg, config.SECTION_COMMON, config.WORKERS, config.DEFAULT_WORKERS))
+
+
+def getBatchRecords(cfg):
+    """
+    Returns the number of log entries usage records are created from at a
+    time (0 for creating each usage record on its own).
+    """
+    return int(config.getConfigValue(cfg, config.SECTION_COMMON, config.BATCH_RECORDS, config.DEFAULT_BATCH_RECORDS))
+
+
+# worker process function and arguments, set by _initWorker
+_worker_func = None
+_worker_args = ()
+
+def _initWorker(func, args):
+    global _worker_func, _worker_args
+    _worker_func = func
+    _worker_args = args
+    profiling.startWorker()
+
+
+def _runWorker(date):
+    return _worker_func(date, *_worker_args)
+
+
+def processBacklogFiles(workers, func, args, dates, result_callback):
+    """
+    Process the (closed) log files for the given dates in a pool of worker
+    processes, each calling func(date, *args) for one log file. The results
+    are passed to result_callback(date, result) in date order, so a date is
+    only reported when all the dates before it have been processed.
+    """
+    # worker processes are forked, so func and args are not pickled
+    pool = multiprocessing.Pool(workers, _initWorker, (func, args))
+    try:
+        results = pool.imap(_runWorker, dates)
+        for date in dates:
+            result_callback(date, results.next())
+        # let the workers exit on their own, so they can write their profiles
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        pool.join()
 
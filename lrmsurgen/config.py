@@ -20,10 +20,25 @@ DEFAULT_MAUI_SPOOL_DIR  = '/var/spool/maui'
 DEFAULT_MAUI_STATE_FILE = 'maui.state'
 DEFAULT_TORQUE_SPOOL_DIR = '/var/spool/torque'
 DEFAULT_TORQUE_STATE_FILE = 'torque.state'
+DEFAULT_STATE_COMMIT_RECORDS  = 100
+DEFAULT_STATE_COMMIT_INTERVAL = 10 # seconds
+DEFAULT_WORKERS         = 1
+DEFAULT_SPOOL           = 'files'
+DEFAULT_SEGMENT_SIZE    = 64 * 1024 * 1024
+DEFAULT_FOLLOW_INTERVAL = 2 # seconds
+DEFAULT_LOG_RECORDS     = 'true'
+DEFAULT_BATCH_RECORDS   = 0
+DEFAULT_AGGREGATE       = 'false'
+DEFAULT_DIRECT_UPLOAD   = 'false'
+DEFAULT_HOSTKEY         = '/etc/grid-security/hostkey.pem'
+DEFAULT_HOSTCERT        = '/etc/grid-security/hostcert.pem'
+DEFAULT_CERTDIR         = '/etc/grid-security/certificates'
+DEFAULT_UPLOAD_BATCH_SIZE = 100
 
 SECTION_COMMON = 'common'
 SECTION_MAUI   = 'maui'
 SECTION_TORQUE = 'torque'
+SECTION_LOGGER = 'logger'
 
 HOSTNAME   = 'hostname'
 USERMAP    = 'usermap'
@@ -31,6 +46,30 @@ VOMAP      = 'vomap'
 LOGDIR     = 'logdir'
 LOGFILE    = 'logfile'
 STATEDIR   = 'statedir'
+STATE_COMMIT_RECORDS  = 'state_commit_records'
+STATE_COMMIT_INTERVAL = 'state_commit_interval'
+WORKERS    = 'workers'
+SPOOL      = 'spool'
+SEGMENT_SIZE = 'segment_size'
+FOLLOW_INTERVAL = 'follow_interval'
+METRICS_DIR = 'metrics_dir'
+LOG_RECORDS = 'log_records'
+BATCH_RECORDS = 'batch_records'
+AGGREGATE  = 'aggregate'
+DIRECT_UPLOAD = 'direct_upload'
+HOSTKEY    = 'x509_user_key'
+HOSTCERT   = 'x509_user_cert'
+CERTDIR    = 'x509_cert_dir'
+
+LOG_ALL    = 'log_all'
+LOG_VO     = 'log_vo'
+COMPRESS   = 'compress'
+BATCH_SIZE = 'batch_size'
+MAX_RETRIES   = 'max_retries'
+RETRY_BACKOFF = 'retry_backoff'
+BREAKER_THRESHOLD = 'breaker_threshold'
+BREAKER_COOLDOWN  = 'breaker_cooldown'
+DISCOVERY_TTL = 'discovery_ttl'
 
 MAUI_SPOOL_DIR  = 'spooldir'
 MAUI_STATE_FILE = 'statefile'
@@ -50,6 +89,16 @@ def getParser():
     parser.add_option('-l', '--log-file', dest='logfile', help='Log file (overwrites config option).')
     parser.add_option('-c', '--config', dest='config', help='Configuration file.',
                       default=DEFAULT_CONFIG_FILE, metavar='FILE')
+    parser.add_option('--migrate-spool', dest='migrate_spool', action='store_true', default=False,
+                      help='Move spooled usage records into segments and exit.')
+    parser.add_option('--extract-record', dest='extract_record', metavar='JOBID',
+                      help='Write an archived usage record to stdout and exit.')
+    parser.add_option('--export-aggregates', dest='export_aggregates', metavar='FORMAT',
+                      help='Write the per-day usage totals to stdout as csv or xml (summary records) and exit.')
+    parser.add_option('-f', '--follow', dest='follow', action='store_true', default=False,
+                      help='Keep running, generating usage records as jobs finish.')
+    parser.add_option('--profile', dest='profile', metavar='PREFIX',
+                      help='Profile the run, writing the profiles to PREFIX.pstats and PREFIX.collapsed.')
     return parser
 
 
@@ -0,0 +1,205 @@
+#
+# Compiled map cache module.
+#
+# Module for the LRMS UR Generator module.
+#
+# The user and vo maps can be large (generated from an identity system), and
+# parsing the text files on every run is slow. Instead they are compiled into
+# a sorted table in <statedir>/mapcache, which is memory mapped and searched
+# with binary search, so only the pages holding the looked up keys are read.
+# A compiled map records the mtime and size of its source file, and is
+# rebuilt when the source file changes.
+#
+# Compiled map format (little endian):
+#
+# header  : magic (8 bytes), source mtime (double), source size (int64),
+#           number of entries (uint32)
+# entries : key offset (uint32), key length (uint32), value length (int32,
+#           -1 for a mapping to None, i.e. "-"), sorted by key
+# data    : key, followed by its value, for each entry
+
+import os
+import mmap
+import zlib
+import struct
+import logging
+
+from lrmsurgen import config
+
+
+
+MAPCACHE_DIRECTORY = 'mapcache'
+MAPCACHE_SUFFIX    = '.cmap'
+
+MAGIC         = 'LRMSMAP1'
+HEADER_FORMAT = '<8sdqI'
+ENTRY_FORMAT  = '<IIi'
+HEADER_SIZE   = struct.calcsize(HEADER_FORMAT)
+ENTRY_SIZE    = struct.calcsize(ENTRY_FORMAT)
+
+_MISSING = object()
+
+
+
+def getCompiledMapPath(cache_dir, map_file):
+    """
+    Returns the location of the compiled map for a map file. The checksum of
+    the path keeps maps with the same name apart.
+    """
+    map_file = os.path.abspath(map_file)
+    checksum = zlib.crc32(map_file) & 0xffffffff
+    return os.path.join(cache_dir, '%s-%08x%s' % (os.path.basename(map_file), checksum, MAPCACHE_SUFFIX))
+
+
+def compileMap(map_, source_stat, compiled_path):
+    """
+    Write a mapping (dict) as a compiled map. The file is written to a
+    temporary file and renamed into place, so readers never see a partial
+    compiled map.
+    """
+    keys = map_.keys()
+    keys.sort()
+
+    entries = []
+    data = []
+    offset = HEADER_SIZE + ENTRY_SIZE * len(keys)
+    for key in keys:
+        value = map_[key]
+        entries.append(struct.pack(ENTRY_FORMAT, offset, len(key), value is None and -1 or len(value)))
+        data.append(key)
+        offset += len(key)
+        if value is not None:
+            data.append(value)
+            offset += len(value)
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, source_stat.st_mtime, source_stat.st_size, len(keys))
+    tmp_path = '%s.%i.tmp' % (compiled_path, os.getpid())
+    f = open(tmp_path, 'wb')
+    f.write(header)
+    f.write(''.join(entries))
+    f.write(''.join(data))
+    f.close()
+    os.rename(tmp_path, compiled_path)
+
+
+
+class CompiledMap:
+    """
+    Read-only mapping backed by a compiled map file. Supports the dict
+    operations used on the user and vo maps (in, [], get, len). Looked up
+    keys are remembered, as the same users show up again and again.
+    """
+    def __init__(self, compiled_path):
+        f = open(compiled_path, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, self.source_mtime, self.source_size, self.count = \
+            struct.unpack(HEADER_FORMAT, self.data[:HEADER_SIZE])
+        if magic != MAGIC:
+            raise ValueError('Invalid compiled map: %s' % compiled_path)
+        self.lookups = {}
+
+
+    def isCurrent(self, source_stat):
+        return self.source_mtime == source_stat.st_mtime and self.source_size == source_stat.st_size
+
+
+    def _lookup(self, key):
+        data = self.data
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            entry_offset = HEADER_SIZE + mid * ENTRY_SIZE
+            key_offset, key_length, value_length = \
+                struct.unpack(ENTRY_FORMAT, data[entry_offset:entry_offset + ENTRY_SIZE])
+            entry_key = data[key_offset:key_offset + key_length]
+            if entry_key < key:
+                lo = mid + 1
+            elif entry_key > key:
+                hi = mid
+            elif value_length == -1:
+                return None
+            else:
+                value_offset = key_offset + key_length
+                return data[value_offset:value_offset + value_length]
+        return _MISSING
+
+
+    def _get(self, key):
+        try:
+            return self.lookups[key]
+        except KeyError:
+            value = self.lookups[key] = self._lookup(key)
+            return value
+
+
+    def __contains__(self, key):
+        return self._get(key) is not _MISSING
+
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is _MISSING:
+            return default
+        return value
+
+
+    def __len__(self):
+        return self.count
+
+
+    def close(self):
+        self.data.close()
+
+
+
+def openCompiledMap(map_file, cache_dir):
+    """
+    Returns the compiled map for a map file, compiling it if the source file
+    has changed since it was compiled (or was never compiled). Raises IOError
+    if the map file does not exist.
+    """
+    source_stat = os.stat(map_file)
+    compiled_path = getCompiledMapPath(cache_dir, map_file)
+
+    if os.path.exists(compiled_path):
+        try:
+            compiled_map = CompiledMap(compiled_path)
+            if compiled_map.isCurrent(source_stat):
+                return compiled_map
+            compiled_map.close()
+        except (ValueError, struct.error, EnvironmentError), e:
+            logging.warning('Could not read compiled map %s (%s), recompiling it' % (compiled_path, e))
+
+    logging.info('Compiling map %s to %s' % (map_file, compiled_path))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    compileMap(config.readFileMap(map_file), source_stat, compiled_path)
+    return CompiledMap(compiled_path)
+
+
+def getMapping(cfg, map_file):
+    """
+    Returns the mapping in a map file, as a compiled map in the state
+    directory. If the map cannot be compiled (e.g., the state directory is
+    not writable), the map file is read into a dict. Raises IOError if the map
+    file does not exist.
+    """
+    state_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.STATEDIR, config.DEFAULT_STATEDIR)
+    cache_dir = os.path.join(state_dir, MAPCACHE_DIRECTORY)
+    if not os.path.exists(map_file):
+        raise IOError('Map file %s does not exist' % map_file)
+    try:
+        return openCompiledMap(map_file, cache_dir)
+    except EnvironmentError, e:
+        logging.warning('Could not compile map %s (%s), reading it directly' % (map_file, e))
+        return config.getMapping(map_file)
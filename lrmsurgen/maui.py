@@ -10,7 +10,7 @@ import os
 import time
 import logging
 
-from lrmsurgen import config, common, usagerecord
+from lrmsurgen import aggregate, config, columnar, common, metrics, upload, usagerecord
 
 
 
@@ -25,9 +25,13 @@ class MauiLogParser:
     """
     Parser for maui stats log.
     """
-    def __init__(self, log_file):
+    def __init__(self, log_file, follow=False):
         self.log_file = log_file
+        self.follow = follow  # if True, incomplete lines are left for later
         self.file_ = None
+        self.offset = 0       # offset of the next line in the file
+        self.line_offset = 0  # offset of the last line returned
+        self.line = None      # last line returned
 
 
     def openFile(self):
@@ -45,6 +49,12 @@ class MauiLogParser:
 
         while True:
             line = self.file_.readline()
+            if self.follow and not line.endswith('\n'):
+                # end of file, or a line which is being written (seek clears eof)
+                self.file_.seek(self.offset)
+                return None
+            line_offset = self.offset
+            self.offset += len(line)
             if line.startswith('VERSION'):
                 continue # maui log files starts with a version, typically 230
             if line.startswith('#'):
@@ -52,6 +62,8 @@ class MauiLogParser:
             if line == '': # last line
                 return None
 
+            self.line_offset = line_offset
+            self.line = line
             return line
 
 
@@ -69,6 +81,31 @@ class MauiLogParser:
                 break
 
 
+    def spoolToCheckpoint(self, entry_id, checkpoint):
+        """
+        Seek directly to the entry described by checkpoint, falling back to
+        spooling through the file if the checkpoint does not match.
+        """
+        if self.file_ is None:
+            self.openFile()
+
+        if checkpoint is not None:
+            offset = common.seekCheckpoint(self.file_, checkpoint)
+            if offset is not None:
+                self.offset = offset
+                return
+            logging.info('Checkpoint for %s does not match file, spooling to entry %s' % (self.log_file, entry_id))
+
+        self.spoolToEntry(entry_id)
+
+
+    def getCheckpoint(self):
+        """
+        Returns a checkpoint for the last entry returned.
+        """
+        return common.getCheckpoint(self.file_, self.line_offset, self.line)
+
+
 def getMauiServer(maui_spool_dir):
 
     SERVERHOST = 'SERVERHOST'
@@ -94,16 +131,71 @@ def createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, m
 
     # extract data from the workload trace (log_entry)
 
-    job_id       = log_entry[0]
-    user_name    = log_entry[3]
-    req_class    = log_entry[7]
     submit_time  = int(log_entry[8])
     start_time   = int(log_entry[10])
     end_time     = int(log_entry[11])
     alo_tasks    = int(log_entry[21])
-    account_name = log_entry[25]
     utilized_cpu = float(log_entry[29])
     core_count   = int(log_entry[31])*alo_tasks
+
+    wall_time = end_time - start_time
+
+    # okay, this is somewhat ridiculous and complicated:
+    # When compiled on linux, maui will think that it will only get cputime reading
+    # from the master node. To compensate for this it multiples the utilized cpu field
+    # with the number of tasks. However on most newer torque installations the correct
+    # cpu utilization is reported. When combined this creates abnormally high cpu time
+    # values for parallel jobs. The following heuristic tries to compensate for this,
+    # by checking if the cpu time is higher than wall_time * cpus (which it never should
+    # be), and then correct the number. However this will not work for jobs with very
+    # low efficiancy
+
+    if utilized_cpu > wall_time * alo_tasks:
+        utilized_cpu /= alo_tasks
+
+    return _buildUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, missing_user_mappings,
+                             usagerecord.epoch2isoTime(submit_time), usagerecord.epoch2isoTime(start_time),
+                             usagerecord.epoch2isoTime(end_time), utilized_cpu, wall_time, core_count)
+
+
+
+def createUsageRecords(log_entries, hostname, user_map, vo_map, maui_server_host, missing_user_mappings):
+    """
+    Creates Usage Record objects given a batch of Maui log entries. The
+    numeric fields are computed column-wise (see columnar), the records are
+    the same as the ones createUsageRecord creates.
+    """
+    submit_times  = columnar.intColumn([ e[8] for e in log_entries ])
+    start_times   = columnar.intColumn([ e[10] for e in log_entries ])
+    end_times     = columnar.intColumn([ e[11] for e in log_entries ])
+    alo_tasks     = columnar.intColumn([ e[21] for e in log_entries ])
+    utilized_cpus = columnar.floatColumn([ e[29] for e in log_entries ])
+    task_cores    = columnar.intColumn([ e[31] for e in log_entries ])
+
+    wall_times    = columnar.subtract(end_times, start_times)
+    utilized_cpus = columnar.correctCPUTimes(utilized_cpus, wall_times, alo_tasks)
+    core_counts   = columnar.multiply(task_cores, alo_tasks)
+
+    columns = zip(log_entries,
+                  columnar.isoTimes(submit_times), columnar.isoTimes(start_times), columnar.isoTimes(end_times),
+                  columnar.toList(utilized_cpus), columnar.toList(wall_times), columnar.toList(core_counts))
+
+    return [ _buildUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, missing_user_mappings,
+                               submit_time, start_time, end_time, utilized_cpu, wall_time, core_count)
+             for log_entry, submit_time, start_time, end_time, utilized_cpu, wall_time, core_count in columns ]
+
+
+
+def _buildUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, missing_user_mappings,
+                      submit_time, start_time, end_time, utilized_cpu, wall_time, core_count):
+    """
+    Creates a Usage Record object from a Maui log entry and the fields
+    computed from it (times in ISO format).
+    """
+    job_id       = log_entry[0]
+    user_name    = log_entry[3]
+    req_class    = log_entry[7]
+    account_name = log_entry[25]
     hosts        = log_entry[37].split(':')
 
     # clean data and create various composite entries from the work load trace
@@ -133,21 +225,6 @@ def createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, m
         voi = usagerecord.VOInformation(name=mapped_vo, type_='lrmsurgen-vomap')
         vo_info = [voi]
 
-    wall_time = end_time - start_time
-
-    # okay, this is somewhat ridiculous and complicated:
-    # When compiled on linux, maui will think that it will only get cputime reading
-    # from the master node. To compensate for this it multiples the utilized cpu field
-    # with the number of tasks. However on most newer torque installations the correct
-    # cpu utilization is reported. When combined this creates abnormally high cpu time
-    # values for parallel jobs. The following heuristic tries to compensate for this,
-    # by checking if the cpu time is higher than wall_time * cpus (which it never should
-    # be), and then correct the number. However this will not work for jobs with very
-    # low efficiancy
-
-    if utilized_cpu > wall_time * alo_tasks:
-        utilized_cpu /= alo_tasks
-
     ## fill in usage record fields
 
     ur = usagerecord.UsageRecord()
@@ -167,103 +244,253 @@ def createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, m
     ur.node_count = len(hosts)
     ur.host = ','.join(hosts)
 
-    ur.submit_time = usagerecord.epoch2isoTime(submit_time)
-    ur.start_time  = usagerecord.epoch2isoTime(start_time)
-    ur.end_time    = usagerecord.epoch2isoTime(end_time)
+    ur.submit_time = submit_time
+    ur.start_time  = start_time
+    ur.end_time    = end_time
 
     ur.cpu_duration = utilized_cpu
     ur.wall_duration = wall_time
 
     ur.project_name = account_name
-    ur.vo_info += vo_info
+    ur.vo_info = vo_info
 
     return ur
 
 
 
-def shouldGenerateUR(log_entry, user_map):
+# reasons for not generating a usage record from a log entry
+SKIP_INVALID_ENTRY = 'invalid_entry'
+SKIP_JOB_STATE     = 'job_state'
+SKIP_USER          = 'user_skipped'
+
+def getSkipReason(log_entry, user_map):
     """
-    Decides wheater a log entry is 'suitable' for generating
-    a ur from.
+    Decides wheater a log entry is 'suitable' for generating a ur from.
+    Returns None if it is, and the reason for skipping it otherwise.
     """
-    job_id    = log_entry[0]
-    user_name = log_entry[3]
     job_state = log_entry[6]
+    user_name = log_entry[3]
 
     if not job_state == 'Completed':
-        logging.info('Job %s: Skipping UR generation (state %s)' % (job_id, job_state))
-        return False
+        return SKIP_JOB_STATE
     if user_name in user_map and user_map[user_name] is None:
-        logging.info('Job %s: User configured to skip UR generation' % job_id)
-        return False
+        return SKIP_USER
 
-    return True
+    return None
 
 
 
-def generateUsageRecords(cfg, hostname, user_map, vo_map):
+def processLogFile(mlp, maui_date, hostname, user_map, vo_map, maui_server_host,
+                   ur_spool, missing_user_mappings, state_writer=None, missing_ok=False,
+                   run_metrics=None, log_records=True, batch_records=0, aggregator=None):
     """
-    Starts the UR generation process.
+    Generates usage records from the entries in a Maui stats log file, which
+    the parser has not read yet. Returns the job id and checkpoint of the last
+    usage record written. If batch_records is set, the usage records are
+    created from batches of that many entries (see createUsageRecords).
+    Every usage record written is added to the usage totals of aggregator,
+    if given.
     """
+    last_job_id, last_checkpoint = None, None
+    if run_metrics is None:
+        run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
 
-    maui_spool_dir = config.getConfigValue(cfg, config.SECTION_MAUI, config.MAUI_SPOOL_DIR,
-                                           config.DEFAULT_MAUI_SPOOL_DIR)
-    maui_server_host = getMauiServer(maui_spool_dir)
-    maui_date_today = time.strftime(MAUI_DATE_FORMAT, time.gmtime())
-    job_id, maui_date = common.getGeneratorState(cfg, MAUI_DATE_FORMAT)
-
-    missing_user_mappings = {}
-
-    while True:
+    entries, written = 0, 0
+    skipped = {}
+    parse_time, serialize_time, write_time = 0.0, 0.0, 0.0
+    end_of_log = False
 
-        log_file = os.path.join(maui_spool_dir, STATS_DIR, maui_date)
-        mlp = MauiLogParser(log_file)
-        if job_id is not None:
-            mlp.spoolToEntry(job_id)
-
-        while True:
+    while not end_of_log:
 
+        t0 = time.time()
+        batch = [] # (log entry, checkpoint)
+        while len(batch) < max(batch_records, 1):
             try:
                 log_entry = mlp.getNextLogEntry()
             except IOError:
-                if maui_date == maui_date_today: # todays entry might not exist yet
-                    #logging.info('Error opening log file for today')
-                    break
-                logging.error('Error opening log file at %s for date %s' % (log_file, maui_date))
+                if not missing_ok: # todays entry might not exist yet
+                    logging.error('Error opening log file at %s for date %s' % (mlp.log_file, maui_date))
+                end_of_log = True
                 break
 
             if log_entry is None:
+                end_of_log = True
                 break # no more log entries
+            entries += 1
 
             if len(log_entry) != 44:
                 logging.error('Read entry with an invalid number fields:')
-                logging.error(' - File %s contains entry with %i fields. First field: %s' % (log_file, len(log_entry), log_entry[0]))
+                logging.error(' - File %s contains entry with %i fields. First field: %s' % (mlp.log_file, len(log_entry), log_entry[0]))
                 logging.error(' - No usage record will be generated from this line')
+                skipped[SKIP_INVALID_ENTRY] = skipped.get(SKIP_INVALID_ENTRY, 0) + 1
                 continue
 
-            job_id = log_entry[0]
-            if not shouldGenerateUR(log_entry, user_map):
-                logging.debug('Job %s: No UR will be generated.' % job_id)
+            skip_reason = getSkipReason(log_entry, user_map)
+            if skip_reason is not None:
+                skipped[skip_reason] = skipped.get(skip_reason, 0) + 1
+                if log_records:
+                    if skip_reason == SKIP_USER:
+                        logging.info('Job %s: User configured to skip UR generation' % log_entry[0])
+                    else:
+                        logging.info('Job %s: Skipping UR generation (state %s)' % (log_entry[0], log_entry[6]))
                 continue
 
-            ur = createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, missing_user_mappings)
-            log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
-            ur_dir = os.path.join(log_dir, 'urs')
-            if not os.path.exists(ur_dir):
-                os.makedirs(ur_dir)
+            batch.append( (log_entry, mlp.getCheckpoint()) )
+
+        if not batch:
+            continue
 
-            ur_file = os.path.join(ur_dir, job_id)
-            ur.writeXML(ur_file)
-            common.writeGeneratorState(cfg, job_id, maui_date)
-            logging.info('Wrote usage record to %s' % ur_file)
+        log_entries = [ log_entry for log_entry, _ in batch ]
+        if batch_records:
+            urs = createUsageRecords(log_entries, hostname, user_map, vo_map, maui_server_host, missing_user_mappings)
+        else:
+            urs = [ createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host, missing_user_mappings)
+                    for log_entry in log_entries ]
+        parse_time += time.time() - t0
+
+        for (log_entry, checkpoint), ur in zip(batch, urs):
+            job_id = log_entry[0]
+            t1 = time.time()
+            data = ur.toXML()
+            t2 = time.time()
+            ur_location = ur_spool.add(job_id, ur, data)
+            serialize_time += t2 - t1
+            write_time += time.time() - t2
+            written += 1
+
+            last_job_id, last_checkpoint = job_id, checkpoint
+            if aggregator is not None:
+                aggregator.add(ur, maui_date, checkpoint[0])
+            if state_writer is not None:
+                state_writer.update(job_id, maui_date, last_checkpoint)
+            if log_records:
+                logging.info('Wrote usage record to %s' % ur_location)
+
+    run_metrics.inc('log_entries_read_total', entries)
+    run_metrics.inc('records_written_total', written)
+    for reason, count in skipped.items():
+        run_metrics.inc('records_skipped_total', count, reason=reason)
+    run_metrics.inc('stage_seconds_total', parse_time, stage='parse')
+    run_metrics.inc('stage_seconds_total', serialize_time, stage='serialize')
+    run_metrics.inc('stage_seconds_total', write_time, stage='write')
+    return last_job_id, last_checkpoint
+
+
+
+def processBacklogFile(maui_date, cfg, maui_stats_dir, hostname, user_map, vo_map, maui_server_host,
+                       log_records, batch_records):
+    """
+    Generates usage records from a closed Maui stats log file, in a worker process.
+    """
+    missing_user_mappings = {}
+    run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
+    aggregator = aggregate.createAggregator(cfg)
+    mlp = MauiLogParser(os.path.join(maui_stats_dir, maui_date))
+    ur_spool = upload.createSpool(cfg, run_metrics)
+    job_id, checkpoint = processLogFile(mlp, maui_date, hostname, user_map, vo_map, maui_server_host,
+                                        ur_spool, missing_user_mappings, run_metrics=run_metrics,
+                                        log_records=log_records, batch_records=batch_records,
+                                        aggregator=aggregator)
+    ur_spool.close()
+    return job_id, checkpoint, missing_user_mappings, run_metrics, aggregator
 
-            job_id = None
+
+
+def generateUsageRecords(cfg, hostname, user_map, vo_map, follow=False, run_metrics=None):
+    """
+    Starts the UR generation process. If follow is True, the stats log is
+    followed for new entries, until the process is stopped. Counters and
+    timings of the run are added to run_metrics.
+    """
+
+    maui_spool_dir = config.getConfigValue(cfg, config.SECTION_MAUI, config.MAUI_SPOOL_DIR,
+                                           config.DEFAULT_MAUI_SPOOL_DIR)
+    maui_stats_dir = os.path.join(maui_spool_dir, STATS_DIR)
+    maui_server_host = getMauiServer(maui_spool_dir)
+    maui_date_today = time.strftime(MAUI_DATE_FORMAT, time.gmtime())
+    job_id, maui_date, checkpoint = common.getGeneratorState(cfg, MAUI_DATE_FORMAT)
+
+    if run_metrics is None:
+        run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
+    log_records = metrics.isRecordLoggingEnabled(cfg)
+    batch_records = common.getBatchRecords(cfg)
+
+    ur_spool = upload.createSpool(cfg, run_metrics)
+    aggregator = aggregate.createAggregator(cfg)
+    state_writer = common.GeneratorStateWriter(cfg, ur_spool, run_metrics, aggregator)
+    workers = common.getWorkerCount(cfg)
+    missing_user_mappings = {}
+
+    def backlogFileProcessed(log_date, result):
+        last_job_id, last_checkpoint, missing, worker_metrics, worker_aggregator = result
+        missing_user_mappings.update(missing)
+        run_metrics.merge(worker_metrics)
+        if aggregator is not None:
+            aggregator.merge(worker_aggregator)
+        if last_job_id is not None:
+            state_writer.update(last_job_id, log_date, last_checkpoint)
+        state_writer.commit()
+
+    while True:
+
+        if job_id is None and workers > 1 and maui_date != maui_date_today:
+            # no partially processed log file, the closed ones can be processed in parallel
+            dates = common.getBacklogDates(maui_date, maui_date_today, MAUI_DATE_FORMAT)
+            args = (cfg, maui_stats_dir, hostname, user_map, vo_map, maui_server_host, log_records, batch_records)
+            common.processBacklogFiles(workers, processBacklogFile, args, dates, backlogFileProcessed)
+            maui_date = maui_date_today
+
+        # only the log of today can still be written to, the closed ones are read to the end
+        mlp = MauiLogParser(os.path.join(maui_stats_dir, maui_date), follow and maui_date == maui_date_today)
+        if job_id is not None:
+            mlp.spoolToCheckpoint(job_id, checkpoint)
+        processLogFile(mlp, maui_date, hostname, user_map, vo_map, maui_server_host,
+                       ur_spool, missing_user_mappings, state_writer, maui_date == maui_date_today,
+                       run_metrics, log_records, batch_records, aggregator)
+        state_writer.commit()
 
         if maui_date == maui_date_today:
             break
 
         maui_date = common.getIncrementalDate(maui_date, MAUI_DATE_FORMAT)
         job_id = None
+        checkpoint = None
+
+    if follow:
+        follow_interval = float(config.getConfigValue(cfg, config.SECTION_COMMON, config.FOLLOW_INTERVAL,
+                                                      config.DEFAULT_FOLLOW_INTERVAL))
+        logging.info('Following Maui stats log %s' % mlp.log_file)
+        entries_read = None
+        try:
+            while True:
+                processLogFile(mlp, maui_date, hostname, user_map, vo_map, maui_server_host,
+                               ur_spool, missing_user_mappings, state_writer, True, run_metrics, log_records,
+                               aggregator=aggregator)
+                state_writer.commit()
+
+                next_date = common.getNextLogDate(maui_stats_dir, maui_date, MAUI_DATE_FORMAT)
+                if next_date is not None:
+                    # maui has moved on to a later day, get the last entries in the current log
+                    mlp.follow = False # the log is closed, so a last line without newline is complete
+                    processLogFile(mlp, maui_date, hostname, user_map, vo_map, maui_server_host,
+                                   ur_spool, missing_user_mappings, state_writer, True, run_metrics, log_records,
+                                   aggregator=aggregator)
+                    state_writer.commit()
+                    maui_date = next_date
+                    mlp = MauiLogParser(os.path.join(maui_stats_dir, next_date), follow)
+                    logging.info('Following Maui stats log %s' % mlp.log_file)
+                    continue
+
+                if run_metrics.get('log_entries_read_total') != entries_read:
+                    # the run does not end, so the metrics are updated as new entries are processed
+                    entries_read = run_metrics.get('log_entries_read_total')
+                    run_metrics.write()
+                time.sleep(follow_interval)
+        finally:
+            state_writer.commit()
+            ur_spool.close()
+
+    ur_spool.close()
 
     if missing_user_mappings:
         users = ','.join(missing_user_mappings)
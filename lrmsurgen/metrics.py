@@ -0,0 +1,216 @@
+#
+# Run metrics module.
+#
+# Module for the LRMS UR Generator module.
+#
+# Counters, gauges and histograms collected during a run of the generator or
+# the registrant. At the end of the run they are written to the configured
+# metrics directory, as a Prometheus textfile collector file (<name>.prom) and
+# as JSON (<name>.json). Both files are written to a temporary file first and
+# renamed into place, so a reader never sees a partial file.
+
+import os
+import time
+
+try:
+    import json
+except ImportError:
+    # Python 2.4/2.5 compatability
+    import simplejson as json
+
+from lrmsurgen import config
+
+
+
+GENERATOR_METRICS  = 'lrmsurgen_generator'
+REGISTRANT_METRICS = 'lrmsurgen_registrant'
+
+COUNTER   = 'counter'
+GAUGE     = 'gauge'
+HISTOGRAM = 'histogram'
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+
+def _labelKey(labels):
+    items = labels.items()
+    items.sort()
+    return tuple(items)
+
+
+def _formatLabels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda v : str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join([ '%s="%s"' % (k, escape(v)) for k, v in pairs ]) + '}'
+
+
+def _formatValue(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+
+class Metrics:
+    """
+    Metrics of a run. Metric names are given without the name of the metrics
+    (e.g. lrmsurgen_generator), which is used as prefix when the metrics are
+    written. Labels are given as keyword arguments.
+    """
+    def __init__(self, name, metrics_dir=None):
+        self.name = name
+        self.prefix = name + '_'
+        self.metrics_dir = metrics_dir
+        self.metrics = {} # name -> (type, { label key : value })
+        self.buckets = {} # histogram name -> bucket upper bounds
+        self.start_time = time.time()
+
+
+    def _values(self, name, type_):
+        if not name in self.metrics:
+            self.metrics[name] = (type_, {})
+        return self.metrics[name][1]
+
+
+    def inc(self, name, value=1, **labels):
+        values = self._values(name, COUNTER)
+        key = _labelKey(labels)
+        values[key] = values.get(key, 0) + value
+
+
+    def set(self, name, value, **labels):
+        self._values(name, GAUGE)[_labelKey(labels)] = value
+
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation to a histogram.
+        """
+        values = self._values(name, HISTOGRAM)
+        buckets = self.buckets.setdefault(name, DEFAULT_BUCKETS)
+        key = _labelKey(labels)
+        if not key in values:
+            values[key] = [ [0] * len(buckets), 0, 0.0 ] # bucket counts, count, sum
+        counts = values[key]
+        for i in range(len(buckets)):
+            if value <= buckets[i]:
+                counts[0][i] += 1
+        counts[1] += 1
+        counts[2] += value
+
+
+    def get(self, name, **labels):
+        """
+        Returns the value of a counter or gauge (0 if it has not been set).
+        """
+        if not name in self.metrics:
+            return 0
+        return self.metrics[name][1].get(_labelKey(labels), 0)
+
+
+    def merge(self, other):
+        """
+        Add the counters and histograms of another Metrics object (e.g., from
+        a worker process) to this one. Gauges are replaced.
+        """
+        for name, (type_, values) in other.metrics.items():
+            for key, value in values.items():
+                labels = dict(key)
+                if type_ == COUNTER:
+                    self.inc(name, value, **labels)
+                elif type_ == GAUGE:
+                    self.set(name, value, **labels)
+                else:
+                    self.buckets[name] = other.buckets[name]
+                    own = self._values(name, HISTOGRAM).setdefault(key, [ [0] * len(value[0]), 0, 0.0 ])
+                    own[0] = [ a + b for a, b in zip(own[0], value[0]) ]
+                    own[1] += value[1]
+                    own[2] += value[2]
+
+
+    def finish(self):
+        """
+        Set the run duration and timestamp gauges, and write the metrics.
+        Call at the end of the run.
+        """
+        now = time.time()
+        self.set('run_duration_seconds', now - self.start_time)
+        self.set('last_run_timestamp_seconds', now)
+        self.write()
+
+
+    def formatPrometheus(self):
+        lines = []
+        names = self.metrics.keys()
+        names.sort()
+        for name in names:
+            type_, values = self.metrics[name]
+            full_name = self.prefix + name
+            lines.append('# TYPE %s %s' % (full_name, type_))
+            keys = values.keys()
+            keys.sort()
+            for key in keys:
+                if type_ != HISTOGRAM:
+                    lines.append('%s%s %s' % (full_name, _formatLabels(key), _formatValue(values[key])))
+                    continue
+                bucket_counts, count, sum_ = values[key]
+                for le, bucket_count in zip(self.buckets[name], bucket_counts):
+                    lines.append('%s_bucket%s %i' % (full_name, _formatLabels(key, [('le', _formatValue(le))]), bucket_count))
+                lines.append('%s_bucket%s %i' % (full_name, _formatLabels(key, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (full_name, _formatLabels(key), _formatValue(sum_)))
+                lines.append('%s_count%s %i' % (full_name, _formatLabels(key), count))
+        return '\n'.join(lines) + '\n'
+
+
+    def formatJSON(self):
+        doc = {}
+        for name, (type_, values) in self.metrics.items():
+            samples = []
+            for key, value in values.items():
+                sample = { 'labels' : dict(key) }
+                if type_ == HISTOGRAM:
+                    sample['buckets'] = dict(zip([ _formatValue(le) for le in self.buckets[name] ], value[0]))
+                    sample['count'] = value[1]
+                    sample['sum'] = value[2]
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            doc[self.prefix + name] = { 'type' : type_, 'samples' : samples }
+        return json.dumps(doc, indent=1, sort_keys=True) + '\n'
+
+
+    def write(self):
+        """
+        Write the metrics to <name>.prom and <name>.json in the metrics
+        directory. Does nothing if there is no metrics directory.
+        """
+        if self.metrics_dir is None:
+            return
+        if not os.path.exists(self.metrics_dir):
+            os.makedirs(self.metrics_dir)
+        for suffix, data in ( ('.prom', self.formatPrometheus()), ('.json', self.formatJSON()) ):
+            path = os.path.join(self.metrics_dir, self.name + suffix)
+            # the textfile collector reads all *.prom files, so the temporary file must not match
+            tmp_path = os.path.join(self.metrics_dir, '.' + self.name + suffix + '.tmp')
+            f = open(tmp_path, 'w')
+            f.write(data)
+            f.close()
+            os.rename(tmp_path, path)
+
+
+
+def createMetrics(cfg, name):
+    """
+    Create the metrics of a run, written to the configured metrics directory
+    (if any).
+    """
+    return Metrics(name, config.getConfigValue(cfg, config.SECTION_COMMON, config.METRICS_DIR))
+
+
+def isRecordLoggingEnabled(cfg):
+    value = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOG_RECORDS, config.DEFAULT_LOG_RECORDS)
+    return str(value).lower() in ('true', 'yes', '1')
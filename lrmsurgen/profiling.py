@@ -0,0 +1,246 @@
+#
+# Profiling module, for the --profile option of the generator and registrant.
+#
+# Module for the LRMS UR Generator module.
+#
+# While profiling is active, the run is profiled with cProfile, and the call
+# stack is sampled on SIGPROF (i.e., every SAMPLE_INTERVAL seconds of cpu
+# time). When profiling is stopped, the following files are written:
+#
+# <prefix>.pstats    : cProfile stats, for pstats/snakeviz/etc.
+# <prefix>.collapsed : Sampled stacks in the collapsed format ("frame;frame;...
+#                      count" lines), for flamegraph.pl, speedscope, etc.
+# <prefix>.stages    : Wall-clock time of the stages wrapped with stage(),
+#                      e.g. the Deferred chains of the registrant, which the
+#                      cpu profiles do not show (time waiting for the network).
+#
+# Forked worker processes (the backlog workers of the generator) are profiled
+# on their own, writing to <prefix>.<pid>.* when they exit. These are merged
+# into the profiles of the run when profiling is stopped, and removed.
+#
+# When profiling is not active stage() returns the function unchanged, so
+# there is no overhead.
+
+import os
+import glob
+import time
+import signal
+import pstats
+
+try:
+    import cProfile as profile
+except ImportError:
+    # Python 2.4 compatability
+    import profile
+
+try:
+    from multiprocessing import util as multiprocessing_util
+except ImportError:
+    # Python 2.5 and older, there are no worker processes
+    multiprocessing_util = None
+
+
+SAMPLE_INTERVAL = 0.005 # seconds of cpu time
+
+STATS_SUFFIX     = '.pstats'
+COLLAPSED_SUFFIX = '.collapsed'
+STAGES_SUFFIX    = '.stages'
+
+# the active profiler, if any
+_profiler = None
+
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return '%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+
+class Profiler:
+    """
+    cProfile profiler, stack sampler and stage timer of a run.
+    """
+    def __init__(self, prefix, sample_interval=SAMPLE_INTERVAL):
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self.profile = profile.Profile()
+        self.stacks = {} # collapsed stack -> samples
+        self.stages = {} # stage name -> [ calls, total seconds, max seconds ]
+        self.previous_handler = None
+        self.start_time = None
+
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frameName(frame))
+            frame = frame.f_back
+        names.reverse()
+        stack = ';'.join(names)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+    def start(self):
+        self.start_time = time.time()
+        if hasattr(signal, 'setitimer'): # Python 2.6 and later
+            self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            # restart system calls interrupted by the sampling
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+        self.profile.enable()
+
+
+    def stop(self):
+        self.profile.disable()
+        if hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+
+    def addStage(self, name, seconds):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [ 0, 0.0, 0.0 ]
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2] = max(stage[2], seconds)
+
+
+    def _mergeWorkers(self):
+        """
+        Merge the profiles written by the worker processes of this run into
+        this profiler, and remove them. Returns the merged cProfile stats.
+        """
+        stats = pstats.Stats(self.profile)
+        for stats_file in glob.glob(self.prefix + '.[0-9]*' + STATS_SUFFIX):
+            worker_prefix = stats_file[:-len(STATS_SUFFIX)]
+            if not worker_prefix[len(self.prefix) + 1:].isdigit():
+                continue
+            if os.stat(stats_file).st_mtime < self.start_time:
+                continue # left over from an earlier run
+            stats.add(stats_file)
+
+            worker_files = [ stats_file ]
+            collapsed_file = worker_prefix + COLLAPSED_SUFFIX
+            if os.path.exists(collapsed_file):
+                for line in open(collapsed_file).readlines():
+                    stack, samples = line.rsplit(' ', 1)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + int(samples)
+                worker_files.append(collapsed_file)
+            stages_file = worker_prefix + STAGES_SUFFIX
+            if os.path.exists(stages_file):
+                for line in open(stages_file).readlines():
+                    if line.startswith('#'):
+                        continue
+                    name, calls, total, max_ = line.rstrip('\n').split('\t')
+                    stage = self.stages.setdefault(name, [ 0, 0.0, 0.0 ])
+                    stage[0] += int(calls)
+                    stage[1] += float(total)
+                    stage[2] = max(stage[2], float(max_))
+                worker_files.append(stages_file)
+
+            for worker_file in worker_files:
+                os.unlink(worker_file)
+        return stats
+
+
+    def write(self):
+        """
+        Write the profiles, returns the names of the files written.
+        """
+        files = [ self.prefix + STATS_SUFFIX, self.prefix + COLLAPSED_SUFFIX ]
+        self._mergeWorkers().dump_stats(files[0])
+
+        f = open(files[1], 'w')
+        stacks = self.stacks.items()
+        stacks.sort()
+        for stack, samples in stacks:
+            f.write('%s %i\n' % (stack, samples))
+        f.close()
+
+        if self.stages:
+            files.append(self.prefix + STAGES_SUFFIX)
+            f = open(files[2], 'w')
+            f.write('# stage calls total_seconds max_seconds (stages can overlap)\n')
+            stages = self.stages.items()
+            stages.sort(key=lambda s : -s[1][1])
+            for name, (calls, total, max_) in stages:
+                f.write('%s\t%i\t%.3f\t%.3f\n' % (name, calls, total, max_))
+            f.close()
+        return files
+
+
+
+def start(prefix):
+    """
+    Start profiling the run, the profiles are written to files starting with
+    prefix when stop is called.
+    """
+    global _profiler
+    _profiler = Profiler(prefix)
+    _profiler.start()
+
+
+def stop():
+    """
+    Stop profiling and write the profiles. Returns the names of the files
+    written (none if profiling was not started).
+    """
+    global _profiler
+    if _profiler is None:
+        return []
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    return profiler.write()
+
+
+def startWorker():
+    """
+    Start profiling a forked worker process on its own, if the run is being
+    profiled. The worker inherits the profiler of the parent, which is
+    replaced by one writing to <prefix>.<pid> when the worker exits.
+    """
+    global _profiler
+    if _profiler is None or multiprocessing_util is None:
+        return
+    parent = _profiler
+    parent.stop()
+    _profiler = Profiler('%s.%i' % (parent.prefix, os.getpid()), parent.sample_interval)
+    _profiler.start()
+    # run when the worker exits after the pool is closed
+    multiprocessing_util.Finalize(None, stop, exitpriority=10)
+
+
+def isActive():
+    return _profiler is not None
+
+
+def stage(name, f):
+    """
+    Returns f wrapped so the wall-clock time of its calls is recorded as the
+    stage name. If f returns a Deferred, the stage lasts until the Deferred
+    fires. Returns f itself if profiling is not active.
+    """
+    if _profiler is None:
+        return f
+    profiler = _profiler
+
+    def stageDone(result, start_time):
+        profiler.addStage(name, time.time() - start_time)
+        return result
+
+    def timedStage(*args, **kwargs):
+        start_time = time.time()
+        try:
+            result = f(*args, **kwargs)
+        except:
+            stageDone(None, start_time)
+            raise
+        if hasattr(result, 'addBoth'): # a Deferred
+            result.addBoth(stageDone, start_time)
+        else:
+            stageDone(None, start_time)
+        return result
+
+    return timedStage
@@ -0,0 +1,200 @@
+#
+# Registration service module.
+#
+# Module for the LRMS UR Generator module.
+#
+# The parts of registering usage records which are shared by the registrant
+# and the direct upload of the generator: reading the log points and upload
+# options from the configuration, finding the registration service in the
+# service document of an endpoint, and the cache of the registration services
+# (services.cache in the log directory).
+#
+# Both programs can update the service cache at the same time, so the cache
+# file is read again before every change, and written to a per-process
+# temporary file which is renamed into place.
+
+import os
+import time
+import urlparse
+import ConfigParser
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    # Python 2.4 compatability
+    from elementtree import ElementTree as ET
+
+from lrmsurgen import spool
+
+
+
+DEFAULT_DISCOVERY_TTL = 24 * 60 * 60 # seconds
+
+DEFAULT_MAX_RETRIES       = 3  # per batch
+DEFAULT_RETRY_BACKOFF     = 2  # seconds, doubled for every retry
+DEFAULT_BREAKER_THRESHOLD = 5  # consecutive failed uploads
+DEFAULT_BREAKER_COOLDOWN  = 60 # seconds
+
+# client error response codes which are worth retrying
+RETRYABLE_CODES = [ 408, 429 ]
+
+# response codes by which a server can reject a compressed upload
+COMPRESSION_REJECTED_CODES = [ 400, 415, 501 ]
+COMPRESS_ALL = 'all'
+
+
+
+def isRetryableCode(code):
+    """
+    Returns True if an upload which failed with the response code could
+    succeed if tried again.
+    """
+    return code >= 500 or code in RETRYABLE_CODES
+
+
+
+def getConfigOption(cfg, section, option, default=None):
+    """
+    Returns a configuration option, with quotes removed.
+    """
+    clean = lambda s : type(s) == str and s.strip().replace('"','').replace("'",'') or s
+
+    try:
+        value = cfg.get(section, option)
+        return clean(value)
+    except ConfigParser.NoSectionError:
+        pass
+    except ConfigParser.NoOptionError:
+        pass
+
+    return default
+
+
+def parseLogAll(value):
+    """
+    Returns the endpoints of a log_all option (space separated urls).
+    """
+    if not value:
+        return []
+    return value.split()
+
+
+def parseLogVO(value):
+    """
+    Returns the vo name -> endpoint mapping of a log_vo option ("vo url, ...").
+    """
+    vo_regs = {}
+
+    if not value:
+        return vo_regs
+
+    pairs = value.split(',')
+    for pair in pairs:
+        vo_name, url = pair.strip().split(None, 1)
+        vo_regs[vo_name] = url.strip()
+    return vo_regs
+
+
+def parseCompress(value, log_all, log_vo):
+    """
+    Returns the endpoints uploads are compressed for, given a compress option.
+    """
+    if not value:
+        return []
+    if value.strip() == COMPRESS_ALL:
+        return log_all + log_vo.values()
+    return value.split()
+
+
+
+def createRegistrationURL(location, endpoint):
+    """
+    Returns the url of a registration service, given its location in the
+    service document of the endpoint.
+    """
+    if location.startswith('http'):
+        # location is a complete url, so we just return it
+        return location
+    elif location.startswith('/'):
+        # location is a path, and must be merged with base endpoint to form a suitable url
+        url = urlparse.urlparse(endpoint)
+        reg_url = url[0] + '://' + url[1] + location
+        return reg_url
+    else:
+        raise ValueError('Invalid registration point returned by %s (got: %s)' % (endpoint, location))
+
+
+def parseServiceDocument(body, endpoint):
+    """
+    Returns the url of the registration service in the service document of an
+    endpoint, or None if the endpoint does not have a registration service.
+    """
+    tree = ET.fromstring(body)
+    for service in tree:
+        if service.tag == 'service':
+            found_service = False
+            for ele in service:
+                if ele.tag == 'name' and ele.text == 'Registration':
+                    found_service = True
+                elif ele.tag == 'href' and found_service == True:
+                    return createRegistrationURL(ele.text, endpoint)
+    return None
+
+
+
+class ServiceCache:
+    """
+    Cache of the registration service urls of the endpoints, so the service
+    documents of the endpoints does not have to be fetched every run.
+    """
+    def __init__(self, log_dir, ttl=DEFAULT_DISCOVERY_TTL):
+        self.path = os.path.join(log_dir, spool.SERVICE_CACHE_FILE)
+        self.ttl = ttl
+
+
+    def _read(self):
+        entries = {} # endpoint -> (registration url, time of discovery)
+        if os.path.exists(self.path):
+            for line in open(self.path).readlines():
+                try:
+                    ep, url, discovered = line.split()
+                    entries[ep] = (url, float(discovered))
+                except ValueError:
+                    pass # broken entry, endpoint will be discovered again
+        return entries
+
+
+    def _write(self, entries):
+        tmp_path = '%s.%i.tmp' % (self.path, os.getpid())
+        f = open(tmp_path, 'w')
+        for ep, (url, discovered) in entries.items():
+            f.write('%s %s %i\n' % (ep, url, discovered))
+        f.close()
+        os.rename(tmp_path, self.path)
+
+
+    def get(self, ep):
+        """
+        Returns the registration url of an endpoint, or None if it is not
+        cached or has expired.
+        """
+        entry = self._read().get(ep)
+        if entry is None:
+            return None
+        url, discovered = entry
+        if discovered + self.ttl < time.time():
+            return None
+        return url
+
+
+    def set(self, ep, url):
+        entries = self._read()
+        entries[ep] = (url, time.time())
+        self._write(entries)
+
+
+    def invalidate(self, ep):
+        entries = self._read()
+        if ep in entries:
+            del entries[ep]
+            self._write(entries)
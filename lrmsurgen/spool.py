@@ -0,0 +1,776 @@
+#
+# Usage record spool module.
+#
+# Module for the LRMS UR Generator module.
+#
+# Usage records are spooled in the log directory until they have been
+# registered. Two spool formats exist:
+#
+# files    : One file per usage record in <logdir>/urs, named after the job.
+# segments : Records are appended to segment files in <logdir>/segments. Each
+#            segment has an index file with a "name offset length" line per
+#            record, which is written after the record, so only indexed records
+#            are complete. The writer holds an exclusive lock on the segment
+#            file while it is being appended to, a segment which is not locked
+#            will not change any more.
+#
+# The registrant reads both formats, so switching format does not require
+# migrating already spooled records (but see migrateFileSpool).
+#
+# Along with the records, the generator writes a routing manifest in
+# <logdir>/manifest, with a "name<tab>size<tab>end time[<tab>vo]..." line per
+# record, so the registrant can route records without parsing them. Manifest
+# lines are written after the records they describe, and are locked in the
+# same way as segments. Records without a manifest entry (e.g., spooled by
+# older versions) must be parsed.
+#
+# Records which are not well-formed are moved (or for segments, copied) to
+# <logdir>/quarantine by the registrant, and are not registered. Quarantined
+# records are named "name@location", the location being "segment+offset" for
+# records in segments, so only the quarantined copy of a record is skipped,
+# not later records with the same name (e.g. when job ids wrap around).
+# Records moved from the file spool get a timestamp as location. The
+# quarantine is expired along with the archive.
+#
+# Registered records are archived in per-day bundles in <logdir>/archive. A
+# bundle (YYYYMMDD.bundle) is a sequence of gzip members, each holding a block
+# of records, and has an index (YYYYMMDD.bundle.idx) with a "name block offset
+# block length offset length" line per record, the offset and length being
+# within the uncompressed block. Like segments, index lines are written after
+# the block they refer to. Bundles are expired as a whole.
+
+import os
+import gzip
+import time
+import fcntl
+import calendar
+from StringIO import StringIO
+
+from lrmsurgen import config
+
+
+
+UR_DIRECTORY      = 'urs'
+SEGMENT_DIRECTORY = 'segments'
+MANIFEST_DIRECTORY = 'manifest'
+QUARANTINE_DIRECTORY = 'quarantine'
+ARCHIVE_DIRECTORY = 'archive'
+SEGMENT_SUFFIX    = '.seg'
+INDEX_SUFFIX      = '.idx'
+MANIFEST_SUFFIX   = '.mf'
+BUNDLE_SUFFIX     = '.bundle'
+BUNDLE_INDEX_SUFFIX = '.bundle.idx'
+
+# registration state of the spooled records and the service cache of the
+# registrant, in the log directory (also written by the direct upload)
+REGISTRATIONS_DATABASE = 'registrations.db'
+SERVICE_CACHE_FILE     = 'services.cache'
+
+BUNDLE_DATE_FORMAT = '%Y%m%d'
+BUNDLE_BLOCK_SIZE  = 1024 * 1024 # uncompressed bytes per gzip member
+
+QUARANTINE_SEPARATOR = '@' # between the name and location of a quarantined record
+
+SPOOL_FILES    = 'files'
+SPOOL_SEGMENTS = 'segments'
+
+
+
+def _getFileName(count):
+    # timestamp first, so file names sort in the order they were created
+    return '%s-%i-%06i' % (time.strftime('%Y%m%d%H%M%S', time.gmtime()), os.getpid(), count)
+
+
+
+class ManifestWriter:
+    """
+    Writer for the routing manifest of a spool.
+    """
+    def __init__(self, log_dir):
+        self.manifest_dir = os.path.join(log_dir, MANIFEST_DIRECTORY)
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+        self.manifest_count = 0
+        self.manifest_file = None
+        self.entries = []
+
+
+    def add(self, name, size, ur):
+        """
+        Add a manifest entry for a usage record. The entry is written on the
+        next flush, which must happen after the record itself is on disk.
+        """
+        fields = [ name, str(size), ur.end_time or '-' ] + [ voi.name for voi in ur.vo_info if voi.name ]
+        self.entries.append('\t'.join(fields) + '\n')
+
+
+    def flush(self):
+        if not self.entries:
+            return
+        if self.manifest_file is None:
+            self.manifest_count += 1
+            manifest_path = os.path.join(self.manifest_dir, _getFileName(self.manifest_count) + MANIFEST_SUFFIX)
+            self.manifest_file = open(manifest_path, 'ab')
+            fcntl.flock(self.manifest_file.fileno(), fcntl.LOCK_EX)
+        self.manifest_file.write(''.join(self.entries))
+        self.manifest_file.flush()
+        self.entries = []
+
+
+    def close(self):
+        self.flush()
+        if self.manifest_file is not None:
+            fcntl.flock(self.manifest_file.fileno(), fcntl.LOCK_UN)
+            self.manifest_file.close()
+            self.manifest_file = None
+
+
+
+class FileSpool:
+    """
+    Spool with one file per usage record.
+    """
+    def __init__(self, log_dir):
+        self.ur_dir = os.path.join(log_dir, UR_DIRECTORY)
+        if not os.path.exists(self.ur_dir):
+            os.makedirs(self.ur_dir)
+        self.manifest = ManifestWriter(log_dir)
+
+
+    def add(self, name, ur, data=None):
+        """
+        Add a usage record to the spool, returns the location of the record.
+        The record is serialized, unless data (the serialized record) is given.
+        """
+        ur_file = os.path.join(self.ur_dir, name)
+        if data is None:
+            data = ur.toXML()
+        # write to a temporary (hidden) file first, so readers never see a partial record
+        tmp_file = os.path.join(self.ur_dir, '.' + name + '.tmp')
+        f = open(tmp_file, 'w')
+        f.write(data)
+        f.close()
+        os.rename(tmp_file, ur_file)
+        self.manifest.add(name, len(data), ur)
+        return ur_file
+
+
+    def flush(self):
+        self.manifest.flush()
+
+
+    def close(self):
+        self.manifest.close()
+
+
+
+class SegmentSpool:
+    """
+    Spool which appends usage records to segment files.
+    """
+    def __init__(self, log_dir, segment_size=config.DEFAULT_SEGMENT_SIZE):
+        self.segment_dir = os.path.join(log_dir, SEGMENT_DIRECTORY)
+        if not os.path.exists(self.segment_dir):
+            os.makedirs(self.segment_dir)
+        self.segment_size = segment_size
+        self.segment_count = 0
+        self.segment_path = None
+        self.segment_file = None
+        self.index_file = None
+        self.index_entries = []
+        self.offset = 0
+        self.manifest = ManifestWriter(log_dir)
+
+
+    def _openSegment(self):
+        self.segment_count += 1
+        segment_name = _getFileName(self.segment_count)
+        self.segment_path = os.path.join(self.segment_dir, segment_name + SEGMENT_SUFFIX)
+        self.segment_file = open(self.segment_path, 'ab')
+        # lock before creating the index, readers ignore segments without one
+        fcntl.flock(self.segment_file.fileno(), fcntl.LOCK_EX)
+        self.index_file = open(os.path.join(self.segment_dir, segment_name + INDEX_SUFFIX), 'ab')
+        self.offset = 0
+
+
+    def _closeSegment(self):
+        self.flush()
+        self.index_file.close()
+        fcntl.flock(self.segment_file.fileno(), fcntl.LOCK_UN)
+        self.segment_file.close()
+        self.segment_path = None
+        self.segment_file = None
+        self.index_file = None
+
+
+    def addData(self, name, data):
+        """
+        Append a serialized usage record to the current segment.
+        """
+        if self.segment_file is None:
+            self._openSegment()
+
+        self.segment_file.write(data)
+        self.index_entries.append('%s %i %i\n' % (name, self.offset, len(data)))
+        self.offset += len(data)
+
+        location = '%s:%s' % (self.segment_path, name)
+        if self.offset >= self.segment_size:
+            self._closeSegment()
+        return location
+
+
+    def add(self, name, ur, data=None):
+        """
+        Add a usage record to the spool, returns the location of the record.
+        The record is serialized, unless data (the serialized record) is given.
+        """
+        if data is None:
+            data = ur.toXML()
+        location = self.addData(name, data)
+        self.manifest.add(name, len(data), ur)
+        return location
+
+
+    def flush(self):
+        """
+        Flush records to disk, making them visible to readers.
+        """
+        if self.segment_file is not None:
+            # the data must be on disk before the index refers to it
+            self.segment_file.flush()
+            self.index_file.write(''.join(self.index_entries))
+            self.index_file.flush()
+            self.index_entries = []
+        self.manifest.flush()
+
+
+    def close(self):
+        if self.segment_file is not None:
+            self._closeSegment()
+        self.manifest.close()
+
+
+
+def _getSegmentSize(cfg):
+    segment_size = config.getConfigValue(cfg, config.SECTION_COMMON, config.SEGMENT_SIZE)
+    if segment_size is None:
+        return config.DEFAULT_SEGMENT_SIZE
+    return int(segment_size) * 1024 * 1024 # configured in megabytes
+
+
+def createSpool(cfg):
+    """
+    Create the spool configured for the generator.
+    """
+    log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
+    spool_format = config.getConfigValue(cfg, config.SECTION_COMMON, config.SPOOL, config.DEFAULT_SPOOL)
+
+    if spool_format == SPOOL_FILES:
+        return FileSpool(log_dir)
+    elif spool_format == SPOOL_SEGMENTS:
+        return SegmentSpool(log_dir, _getSegmentSize(cfg))
+    else:
+        raise ValueError('Invalid spool format: %s' % spool_format)
+
+
+
+def isActive(path):
+    """
+    Returns True if the segment or manifest is still being written to.
+    """
+    f = open(path)
+    try:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return False
+    finally:
+        f.close()
+
+
+def getSegmentLocation(segment, offset):
+    return '%s+%i' % (segment, offset)
+
+
+def readSegmentIndex(index_path):
+    """
+    Returns a list of (name, offset, length) tuples for the complete records
+    in a segment.
+    """
+    entries = []
+    for line in open(index_path).readlines():
+        if not line.endswith('\n'):
+            break # index entry being written
+        name, offset, length = line.split(' ')
+        entries.append( (name, int(offset), int(length)) )
+    return entries
+
+
+def readManifest(manifest_path):
+    """
+    Returns a list of (name, size, end time, vo names) tuples for the complete
+    entries in a manifest file.
+    """
+    entries = []
+    for line in open(manifest_path).readlines():
+        if not line.endswith('\n'):
+            break # entry being written
+        fields = line[:-1].split('\t')
+        end_time = fields[2]
+        if end_time == '-':
+            end_time = None
+        entries.append( (fields[0], int(fields[1]), end_time, fields[3:]) )
+    return entries
+
+
+
+class SpoolReader:
+    """
+    Reader for spooled usage records, in both the file and segment format.
+    Records are identified by their name (the job id).
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.ur_dir = os.path.join(log_dir, UR_DIRECTORY)
+        self.segment_dir = os.path.join(log_dir, SEGMENT_DIRECTORY)
+        self.manifest_dir = os.path.join(log_dir, MANIFEST_DIRECTORY)
+        self.quarantine_dir = os.path.join(log_dir, QUARANTINE_DIRECTORY)
+        self.records = {}   # name -> (segment name or None, offset, length)
+        self.segments = {}  # segment name -> [ (name, offset, length) ], closed segments only
+        self.manifest = {}  # name -> (size, end time, vo names)
+        self.manifests = {} # manifest file -> [ record names ], closed manifests only
+        self.quarantined = set() # locations of the quarantined records
+        self.open_segments = {}
+
+
+    def scan(self):
+        """
+        Find the usage records in the spool, and return their names.
+        """
+        self.records = {}
+        self.segments = {}
+
+        self.quarantined = set()
+        if os.path.exists(self.quarantine_dir):
+            for filename in os.listdir(self.quarantine_dir):
+                if QUARANTINE_SEPARATOR in filename:
+                    self.quarantined.add(filename.rsplit(QUARANTINE_SEPARATOR, 1)[1])
+
+        if os.path.exists(self.segment_dir):
+            for filename in sorted(os.listdir(self.segment_dir)):
+                if not filename.endswith(INDEX_SUFFIX):
+                    continue
+                segment = filename[:-len(INDEX_SUFFIX)]
+                segment_path = os.path.join(self.segment_dir, segment + SEGMENT_SUFFIX)
+                active = isActive(segment_path)
+                entries = readSegmentIndex(os.path.join(self.segment_dir, filename))
+                for name, offset, length in entries:
+                    if getSegmentLocation(segment, offset) in self.quarantined:
+                        continue
+                    self.records[name] = (segment, offset, length)
+                if not active:
+                    self.segments[segment] = entries
+
+        if os.path.exists(self.ur_dir):
+            for filename in os.listdir(self.ur_dir):
+                # skip if file is not a proper file, or a record being written
+                if filename.startswith('.') or not os.path.isfile(os.path.join(self.ur_dir, filename)):
+                    continue
+                self.records[filename] = (None, 0, None)
+
+        self.manifest = {}
+        self.manifests = {}
+        if os.path.exists(self.manifest_dir):
+            for filename in sorted(os.listdir(self.manifest_dir)):
+                if not filename.endswith(MANIFEST_SUFFIX):
+                    continue
+                manifest_path = os.path.join(self.manifest_dir, filename)
+                active = isActive(manifest_path)
+                entries = readManifest(manifest_path)
+                for name, size, end_time, vos in entries:
+                    self.manifest[name] = (size, end_time, vos)
+                if not active:
+                    self.manifests[filename] = [ e[0] for e in entries ]
+
+        return self.records.keys()
+
+
+    def getManifestEntry(self, name):
+        """
+        Returns (size, end time, vo names) for a record, or None if the record
+        has no manifest entry.
+        """
+        return self.manifest.get(name)
+
+
+    def getSize(self, name):
+        """
+        Returns the size of a (serialized) usage record in bytes.
+        """
+        entry = self.manifest.get(name)
+        if entry is not None:
+            return entry[0]
+        segment, _, length = self.records[name]
+        if segment is not None:
+            return length
+        return os.path.getsize(os.path.join(self.ur_dir, name))
+
+
+    def sortKey(self, name):
+        """
+        Sort key for record names, so records are read in the order they are
+        laid out in the spool.
+        """
+        segment, offset, _ = self.records[name]
+        return (segment or '', offset, name)
+
+
+    def read(self, name):
+        """
+        Returns the (serialized) usage record with the given name.
+        """
+        segment, offset, length = self.records[name]
+        if segment is None:
+            return open(os.path.join(self.ur_dir, name)).read()
+
+        f = self.open_segments.get(segment)
+        if f is None:
+            f = open(os.path.join(self.segment_dir, segment + SEGMENT_SUFFIX), 'rb')
+            self.open_segments[segment] = f
+        f.seek(offset)
+        return f.read(length)
+
+
+    def getLocation(self, name):
+        """
+        Returns the location of a usage record in the spool. Unlike the name,
+        the location of a record in a segment is never reused.
+        """
+        segment, offset, _ = self.records[name]
+        if segment is None:
+            return os.path.join(UR_DIRECTORY, name)
+        return getSegmentLocation(segment, offset)
+
+
+    def quarantine(self, name):
+        """
+        Move a usage record which cannot be registered to the quarantine
+        directory. Records in segments are copied, as segments are archived
+        as a whole.
+        """
+        if not os.path.exists(self.quarantine_dir):
+            os.makedirs(self.quarantine_dir)
+        segment, offset, _ = self.records[name]
+        if segment is None:
+            location = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        else:
+            location = getSegmentLocation(segment, offset)
+        quarantine_file = os.path.join(self.quarantine_dir, name + QUARANTINE_SEPARATOR + location)
+        if segment is None:
+            os.rename(os.path.join(self.ur_dir, name), quarantine_file)
+        else:
+            f = open(quarantine_file, 'wb')
+            f.write(self.read(name))
+            f.close()
+        self.quarantined.add(self.getLocation(name))
+
+
+    def isQuarantined(self, name):
+        return self.getLocation(name) in self.quarantined
+
+
+    def close(self):
+        for f in self.open_segments.values():
+            f.close()
+        self.open_segments = {}
+
+
+    def archive(self, names, archive_dir):
+        """
+        Move usage records into the archive bundle of the day. Records in
+        segments are only archived when all records in the segment has been
+        archived (or quarantined) and the segment is no longer written to.
+        Returns the names of the records that were archived.
+        """
+        names = set(names)
+        archived = []
+        archived_files = []
+        archived_segments = []
+
+        writer = BundleWriter(archive_dir)
+        for name in sorted(names, key=self.sortKey):
+            segment, _, _ = self.records[name]
+            if segment is None:
+                writer.add(name, self.read(name))
+                archived_files.append(name)
+
+        for segment, entries in sorted(self.segments.items()):
+            segment_names = [ e[0] for e in entries ]
+            entries = [ e for e in entries if not getSegmentLocation(segment, e[1]) in self.quarantined ]
+            if not names.issuperset([ e[0] for e in entries ]):
+                continue
+            f = self.open_segments.pop(segment, None)
+            if f is None:
+                f = open(os.path.join(self.segment_dir, segment + SEGMENT_SUFFIX), 'rb')
+            for name, offset, length in entries:
+                f.seek(offset)
+                writer.add(name, f.read(length))
+            f.close()
+            archived_segments.append(segment)
+            archived += [ name for name in segment_names if self.records.get(name, (None,))[0] == segment ]
+
+        # only remove records from the spool once the bundle is on disk
+        writer.close()
+        for name in archived_files:
+            os.unlink(os.path.join(self.ur_dir, name))
+        for segment in archived_segments:
+            for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                os.unlink(os.path.join(self.segment_dir, segment + suffix))
+        archived += archived_files
+
+        # manifests are removed when none of their records are left in the spool
+        remaining = set(self.records).difference(archived)
+        for filename, manifest_names in self.manifests.items():
+            if not remaining.intersection(manifest_names):
+                os.unlink(os.path.join(self.manifest_dir, filename))
+
+        return archived
+
+
+
+class BundleWriter:
+    """
+    Writer for the archive bundle of the current day.
+    """
+    def __init__(self, archive_dir, block_size=BUNDLE_BLOCK_SIZE):
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+        day = time.strftime(BUNDLE_DATE_FORMAT, time.gmtime())
+        self.bundle_path = os.path.join(archive_dir, day + BUNDLE_SUFFIX)
+        self.index_path = os.path.join(archive_dir, day + BUNDLE_INDEX_SUFFIX)
+        self.block_size = block_size
+        self.bundle_file = None
+        self.index_file = None
+        self.records = []
+        self.block_length = 0
+
+
+    def add(self, name, data):
+        self.records.append( (name, data) )
+        self.block_length += len(data)
+        if self.block_length >= self.block_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Compress the buffered records into a block, and append it to the bundle.
+        """
+        if not self.records:
+            return
+        if self.bundle_file is None:
+            self.bundle_file = open(self.bundle_path, 'ab')
+            fcntl.flock(self.bundle_file.fileno(), fcntl.LOCK_EX)
+            self.index_file = open(self.index_path, 'ab')
+
+        buf = StringIO()
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf)
+        offset = 0
+        index_entries = []
+        for name, data in self.records:
+            gz.write(data)
+            index_entries.append( (name, offset, len(data)) )
+            offset += len(data)
+        gz.close()
+        block = buf.getvalue()
+
+        # the bundle may have been appended to since it was opened
+        self.bundle_file.seek(0, 2)
+        block_offset = self.bundle_file.tell()
+        self.bundle_file.write(block)
+        self.bundle_file.flush()
+        self.index_file.write(''.join([ '%s %i %i %i %i\n' % (name, block_offset, len(block), offset, length)
+                                        for name, offset, length in index_entries ]))
+        self.index_file.flush()
+        self.records = []
+        self.block_length = 0
+
+
+    def close(self):
+        self.flush()
+        if self.bundle_file is not None:
+            os.fsync(self.bundle_file.fileno())
+            os.fsync(self.index_file.fileno())
+            self.index_file.close()
+            fcntl.flock(self.bundle_file.fileno(), fcntl.LOCK_UN)
+            self.bundle_file.close()
+            self.bundle_file = None
+            self.index_file = None
+
+
+
+def expireQuarantine(quarantine_dir, ttl_seconds, now=None):
+    """
+    Delete the quarantined records which were quarantined more than
+    ttl_seconds ago. Returns the number of records deleted.
+    """
+    if now is None:
+        now = time.time()
+    if not os.path.exists(quarantine_dir):
+        return 0
+    deleted = 0
+    for filename in os.listdir(quarantine_dir):
+        filepath = os.path.join(quarantine_dir, filename)
+        # the ctime is the time of quarantine, also for records moved there
+        if os.path.isfile(filepath) and os.stat(filepath).st_ctime + ttl_seconds < now:
+            os.unlink(filepath)
+            deleted += 1
+    return deleted
+
+
+
+def readBundleIndex(index_path):
+    """
+    Returns a list of (name, block offset, block length, offset, length)
+    tuples for the complete records in a bundle.
+    """
+    entries = []
+    for line in open(index_path).readlines():
+        if not line.endswith('\n'):
+            break # index entry being written
+        fields = line.split(' ')
+        entries.append( (fields[0],) + tuple([ int(f) for f in fields[1:] ]) )
+    return entries
+
+
+def listBundles(archive_dir):
+    """
+    Returns the dates (as YYYYMMDD strings) of the bundles in the archive,
+    newest first.
+    """
+    if not os.path.exists(archive_dir):
+        return []
+    days = [ fn[:-len(BUNDLE_INDEX_SUFFIX)] for fn in os.listdir(archive_dir) if fn.endswith(BUNDLE_INDEX_SUFFIX) ]
+    days.sort()
+    days.reverse()
+    return days
+
+
+def expireBundles(archive_dir, ttl_seconds, now=None):
+    """
+    Delete the bundles which are entirely older than ttl_seconds. Returns the
+    number of records deleted.
+    """
+    if now is None:
+        now = time.time()
+    deleted = 0
+    for day in listBundles(archive_dir):
+        day_end = calendar.timegm(time.strptime(day, BUNDLE_DATE_FORMAT)) + 24 * 60 * 60
+        if day_end + ttl_seconds >= now:
+            continue
+        index_path = os.path.join(archive_dir, day + BUNDLE_INDEX_SUFFIX)
+        deleted += len(readBundleIndex(index_path))
+        # remove the index first, a bundle without index is not read
+        os.unlink(index_path)
+        bundle_path = os.path.join(archive_dir, day + BUNDLE_SUFFIX)
+        if os.path.exists(bundle_path):
+            os.unlink(bundle_path)
+    return deleted
+
+
+
+class ArchiveReader:
+    """
+    Reader for archived usage records. Looks in the bundles (newest first),
+    and then for records archived as files by older versions.
+    """
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.block_key = None
+        self.block = None
+
+
+    def find(self, name):
+        """
+        Returns (bundle date, block offset, block length, offset, length) for
+        an archived record, or None if the record is not in a bundle.
+        """
+        for day in listBundles(self.archive_dir):
+            entry = None
+            for e in readBundleIndex(os.path.join(self.archive_dir, day + BUNDLE_INDEX_SUFFIX)):
+                if e[0] == name:
+                    entry = e # the last entry wins, a record can be archived twice after a crash
+            if entry is not None:
+                return (day,) + entry[1:]
+        return None
+
+
+    def _readBlock(self, day, block_offset, block_length):
+        if self.block_key != (day, block_offset):
+            f = open(os.path.join(self.archive_dir, day + BUNDLE_SUFFIX), 'rb')
+            try:
+                f.seek(block_offset)
+                data = f.read(block_length)
+            finally:
+                f.close()
+            self.block = gzip.GzipFile(fileobj=StringIO(data)).read()
+            self.block_key = (day, block_offset)
+        return self.block
+
+
+    def read(self, name):
+        """
+        Returns the archived usage record with the given name, raises
+        KeyError if it is not in the archive.
+        """
+        entry = self.find(name)
+        if entry is not None:
+            day, block_offset, block_length, offset, length = entry
+            block = self._readBlock(day, block_offset, block_length)
+            return block[offset:offset+length]
+
+        filepath = os.path.join(self.archive_dir, name)
+        if os.path.isfile(filepath):
+            return open(filepath).read()
+        raise KeyError(name)
+
+
+
+def readArchivedRecord(cfg, name):
+    """
+    Returns an archived usage record, raises KeyError if it is not in the
+    archive.
+    """
+    log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
+    return ArchiveReader(os.path.join(log_dir, ARCHIVE_DIRECTORY)).read(name)
+
+
+
+def migrateFileSpool(cfg):
+    """
+    Move the usage records in the file per record spool into segments.
+    Returns the number of records moved.
+    """
+    log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
+    ur_dir = os.path.join(log_dir, UR_DIRECTORY)
+    if not os.path.exists(ur_dir):
+        return 0
+
+    segment_spool = SegmentSpool(log_dir, _getSegmentSize(cfg))
+    migrated = []
+    for filename in sorted(os.listdir(ur_dir)):
+        filepath = os.path.join(ur_dir, filename)
+        if filename.startswith('.') or not os.path.isfile(filepath):
+            continue
+        segment_spool.addData(filename, open(filepath).read())
+        migrated.append(filepath)
+    segment_spool.close()
+
+    # only remove the files once they are in a closed segment
+    for filepath in migrated:
+        os.unlink(filepath)
+    return len(migrated)
+
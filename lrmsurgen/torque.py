@@ -7,15 +7,20 @@
 # Copyright: Nordic Data Grid Facility (2010)
 
 import os
+import re
 import time
 import logging
 
-from lrmsurgen import config, common, usagerecord
+from lrmsurgen import aggregate, config, columnar, common, metrics, upload, usagerecord
 
 
 
 TORQUE_DATE_FORMAT = '%Y%m%d'
 STATE_FILE       = 'torque.state'
+BLOCK_SIZE       = 1024 * 1024
+
+# the end record fields used for creating usage records (besides jobid and user)
+PROJECTED_FIELDS = re.compile(r' (queue|account|ctime|start|end|exec_host|Resource_List\.nodes|resources_used\.[^=\s]+)=(\S*)')
 
 
 
@@ -26,6 +31,9 @@ class TorqueLogParser:
     def __init__(self, log_file):
         self.log_file = log_file
         self.file_ = None
+        self.offset = 0       # offset of the next line in the file
+        self.line_offset = 0  # offset of the last line returned
+        self.line = None      # last line returned
 
 
     def openFile(self):
@@ -56,9 +64,13 @@ class TorqueLogParser:
 
         while True:
             line = self.file_.readline()
+            line_offset = self.offset
+            self.offset += len(line)
             if line == '': #last line
                 return None
-            if line[20] == 'E':
+            if line[line.find(';')+1:].startswith('E;'):
+                self.line_offset = line_offset
+                self.line = line
                 return line
 
 
@@ -76,6 +88,159 @@ class TorqueLogParser:
                 break
 
 
+    def spoolToCheckpoint(self, entry_id, checkpoint):
+        """
+        Seek directly to the entry described by checkpoint, falling back to
+        spooling through the file if the checkpoint does not match.
+        """
+        if self.file_ is None:
+            self.openFile()
+
+        if checkpoint is not None:
+            offset = common.seekCheckpoint(self.file_, checkpoint)
+            if offset is not None:
+                self.offset = offset
+                return
+            logging.info('Checkpoint for %s does not match file, spooling to entry %s' % (self.log_file, entry_id))
+
+        self.spoolToEntry(entry_id)
+
+
+    def getCheckpoint(self):
+        """
+        Returns a checkpoint for the last entry returned.
+        """
+        return common.getCheckpoint(self.file_, self.line_offset, self.line)
+
+
+
+class TorqueBlockLogParser:
+    """
+    Parser for torque accounting log, optimized for large log files.
+
+    The log is read in large blocks, which are scanned for end (E) records,
+    skipping all other records without looking at them. Only the fields
+    needed for creating usage records are extracted from the end records.
+    """
+    def __init__(self, log_file, block_size=BLOCK_SIZE, follow=False):
+        self.log_file = log_file
+        self.block_size = block_size
+        self.follow = follow   # if True, incomplete lines are left for later
+        self.file_ = None
+        self.buffer = ''
+        self.buffer_offset = 0 # offset of the buffer start in the file
+        self.pos = 0           # position of the next line in the buffer
+        self.line_offset = 0   # offset of the last line returned
+        self.line = None       # last line returned
+
+
+    def openFile(self):
+        self.file_ = open(self.log_file)
+
+
+    def readBlock(self):
+        """
+        Read the next block of the file into the buffer, discarding the part
+        of the buffer which has been consumed. Returns False if at end of file.
+        """
+        block = self.file_.read(self.block_size)
+        self.buffer = self.buffer[self.pos:] + block
+        self.buffer_offset += self.pos
+        self.pos = 0
+        if block == '' and self.follow:
+            # clear eof, so data appended to the file can be read
+            self.file_.seek(self.buffer_offset + len(self.buffer))
+        return block != ''
+
+
+    def splitLineEntry(self, line):
+        start_fields = line.split(';', 3)
+        # the first field is always user, so the projected fields are preceded by a space
+        fields = dict(PROJECTED_FIELDS.findall(start_fields[3]))
+        fields['entrytype'] = start_fields[1]
+        fields['jobid'] = start_fields[2]
+        fields['user'] = start_fields[3].split(' ', 1)[0].split('=')[1]
+        return fields
+
+
+    def getNextLogLine(self):
+        if self.file_ is None:
+            self.openFile()
+
+        while True:
+            i = self.buffer.find(';E;', self.pos)
+            if i == -1:
+                # no end record in the buffer, keep the last (partial) line
+                self.pos = max(self.pos, self.buffer.rfind('\n') + 1)
+                if not self.readBlock():
+                    return None
+                continue
+
+            line_start = self.buffer.rfind('\n', self.pos, i) + 1 or self.pos
+            line_end = self.buffer.find('\n', i) + 1
+            if line_end == 0:
+                # end record continues in the next block
+                self.pos = line_start
+                if self.readBlock():
+                    continue
+                if self.follow:
+                    return None # line is being written
+                # last line, without newline (now at the start of the buffer)
+                i -= line_start
+                line_start = 0
+                line_end = len(self.buffer)
+
+            self.pos = line_end
+            if self.buffer.find(';', line_start, i) != -1:
+                continue # ;E; is not the record type
+
+            self.line_offset = self.buffer_offset + line_start
+            self.line = self.buffer[line_start:line_end]
+            return self.line
+
+
+    def getNextLogEntry(self):
+        line = self.getNextLogLine()
+        if line is None:
+            return None
+        return self.splitLineEntry(line)
+
+
+    def spoolToEntry(self, entry_id):
+        while True:
+            log_entry = self.getNextLogEntry()
+            if log_entry is None or log_entry['jobid'] == entry_id:
+                break
+
+
+    def spoolToCheckpoint(self, entry_id, checkpoint):
+        """
+        Seek directly to the entry described by checkpoint, falling back to
+        spooling through the file if the checkpoint does not match.
+        """
+        if self.file_ is None:
+            self.openFile()
+
+        if checkpoint is not None:
+            offset = common.seekCheckpoint(self.file_, checkpoint)
+            if offset is not None:
+                self.buffer = ''
+                self.buffer_offset = offset
+                self.pos = 0
+                return
+            logging.info('Checkpoint for %s does not match file, spooling to entry %s' % (self.log_file, entry_id))
+
+        self.spoolToEntry(entry_id)
+
+
+    def getCheckpoint(self):
+        """
+        Returns a checkpoint for the last entry returned.
+        """
+        return common.getCheckpoint(self.file_, self.line_offset, self.line)
+
+
+
 
 def getSeconds(torque_timestamp):
     """
@@ -116,15 +281,50 @@ def createUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappin
     """
 
     # extract data from the workload trace (log_entry)
-    job_id       = log_entry['jobid']
-    user_name    = log_entry['user']
-    queue        = log_entry['queue']
     submit_time  = int(log_entry['ctime'])
     start_time   = int(log_entry['start'])
     end_time     = int(log_entry['end'])
     utilized_cpu = getSeconds(log_entry['resources_used.cput'])
     wall_time    = getSeconds(log_entry['resources_used.walltime'])
     core_count   = getCoreCount(log_entry['Resource_List.nodes'])
+
+    return _buildUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappings,
+                             usagerecord.epoch2isoTime(submit_time), usagerecord.epoch2isoTime(start_time),
+                             usagerecord.epoch2isoTime(end_time), utilized_cpu, wall_time, core_count)
+
+
+def createUsageRecords(log_entries, hostname, user_map, vo_map, missing_user_mappings):
+    """
+    Creates Usage Record objects given a batch of Torque log entries. The
+    numeric fields are computed column-wise (see columnar), the records are
+    the same as the ones createUsageRecord creates.
+    """
+    submit_times  = columnar.intColumn([ e['ctime'] for e in log_entries ])
+    start_times   = columnar.intColumn([ e['start'] for e in log_entries ])
+    end_times     = columnar.intColumn([ e['end'] for e in log_entries ])
+    utilized_cpus = columnar.durationColumn([ e['resources_used.cput'] for e in log_entries ])
+    wall_times    = columnar.durationColumn([ e['resources_used.walltime'] for e in log_entries ])
+    core_counts   = columnar.mapUnique(getCoreCount, [ e['Resource_List.nodes'] for e in log_entries ])
+
+    columns = zip(log_entries,
+                  columnar.isoTimes(submit_times), columnar.isoTimes(start_times), columnar.isoTimes(end_times),
+                  columnar.toList(utilized_cpus), columnar.toList(wall_times), core_counts)
+
+    return [ _buildUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappings,
+                               submit_time, start_time, end_time, utilized_cpu, wall_time, core_count)
+             for log_entry, submit_time, start_time, end_time, utilized_cpu, wall_time, core_count in columns ]
+
+
+def _buildUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappings,
+                      submit_time, start_time, end_time, utilized_cpu, wall_time, core_count):
+    """
+    Creates a Usage Record object from a Torque log entry and the fields
+    computed from it (times in ISO format).
+    """
+    job_id       = log_entry['jobid']
+    user_name    = log_entry['user']
+    queue        = log_entry['queue']
+    account_name = log_entry.get('account') # only set if the job was submitted with an account
     hosts        = list(set([hc.split('/')[0] for hc in log_entry['exec_host'].split('+')]))
 
     # clean data and create various composite entries from the work load trace
@@ -152,74 +352,212 @@ def createUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappin
     ur.global_user_name = user_map.get(user_name)
     ur.machine_name     = hostname
     ur.queue            = queue
+    ur.project_name     = account_name
     ur.processors       = core_count
     ur.node_count       = len(hosts)
     ur.host             = ','.join(hosts)
-    ur.submit_time      = usagerecord.epoch2isoTime(submit_time)
-    ur.start_time       = usagerecord.epoch2isoTime(start_time)
-    ur.end_time         = usagerecord.epoch2isoTime(end_time)
+    ur.submit_time      = submit_time
+    ur.start_time       = start_time
+    ur.end_time         = end_time
     ur.cpu_duration     = utilized_cpu
     ur.wall_duration    = wall_time
-    ur.vo_info         += vo_info
+    ur.vo_info          = vo_info
 
     return ur
 
 
-def generateUsageRecords(cfg, hostname, user_map, vo_map):
+def processLogFile(tlp, torque_date, hostname, user_map, vo_map,
+                   ur_spool, missing_user_mappings, state_writer=None, missing_ok=False,
+                   run_metrics=None, log_records=True, batch_records=0, aggregator=None):
     """
-    Starts the UR generation process.
+    Generates usage records from the entries in a Torque accounting log file,
+    which the parser has not read yet. Returns the job id and checkpoint of the
+    last usage record written. If batch_records is set, the usage records are
+    created from batches of that many entries (see createUsageRecords).
+    Every usage record written is added to the usage totals of aggregator,
+    if given.
     """
+    last_job_id, last_checkpoint = None, None
+    if run_metrics is None:
+        run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
 
-    torque_spool_dir = config.getConfigValue(cfg, config.SECTION_TORQUE,
-                                             config.TORQUE_SPOOL_DIR, config.DEFAULT_TORQUE_SPOOL_DIR)
-    torque_accounting_dir = os.path.join(torque_spool_dir, 'server_priv', 'accounting')
-
-    torque_date_today = time.strftime(TORQUE_DATE_FORMAT, time.gmtime())
-    job_id, torque_date = common.getGeneratorState(cfg, TORQUE_DATE_FORMAT)
+    entries = 0
+    parse_time, serialize_time, write_time = 0.0, 0.0, 0.0
+    end_of_log = False
 
-    missing_user_mappings = {}
-
-    while True:
-
-        log_file = os.path.join(torque_accounting_dir, torque_date)
-        tlp = TorqueLogParser(log_file)
-        if job_id is not None:
-            tlp.spoolToEntry(job_id)
-
-        while True:
+    while not end_of_log:
 
+        t0 = time.time()
+        batch = [] # (log entry, checkpoint)
+        while len(batch) < max(batch_records, 1):
             try:
                 log_entry = tlp.getNextLogEntry()
             except IOError:
-                if torque_date == torque_date_today: # todays entry might not exist yet
-                    #logging.info('Error opening log file for today')
-                    break
-                logging.error('Error opening log file at %s for date %s' % (log_file, torque_date))
+                if not missing_ok: # todays entry might not exist yet
+                    logging.error('Error opening log file at %s for date %s' % (tlp.log_file, torque_date))
+                end_of_log = True
                 break
 
             if log_entry is None:
+                end_of_log = True
                 break # no more log entries
+            entries += 1
+            batch.append( (log_entry, tlp.getCheckpoint()) )
+
+        if not batch:
+            continue
+
+        log_entries = [ log_entry for log_entry, _ in batch ]
+        if batch_records:
+            urs = createUsageRecords(log_entries, hostname, user_map, vo_map, missing_user_mappings)
+        else:
+            urs = [ createUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappings)
+                    for log_entry in log_entries ]
+        parse_time += time.time() - t0
 
+        for (log_entry, checkpoint), ur in zip(batch, urs):
             job_id = log_entry['jobid']
+            t1 = time.time()
+            data = ur.toXML()
+            t2 = time.time()
+            ur_location = ur_spool.add(job_id, ur, data)
+            serialize_time += t2 - t1
+            write_time += time.time() - t2
+
+            last_job_id, last_checkpoint = job_id, checkpoint
+            if aggregator is not None:
+                aggregator.add(ur, torque_date, checkpoint[0])
+            if state_writer is not None:
+                state_writer.update(job_id, torque_date, last_checkpoint)
+            if log_records:
+                logging.info('Wrote usage record to %s' % ur_location)
+
+    # only end records are read from the log, and all of them get a usage record
+    run_metrics.inc('log_entries_read_total', entries)
+    run_metrics.inc('records_written_total', entries)
+    run_metrics.inc('stage_seconds_total', parse_time, stage='parse')
+    run_metrics.inc('stage_seconds_total', serialize_time, stage='serialize')
+    run_metrics.inc('stage_seconds_total', write_time, stage='write')
+    return last_job_id, last_checkpoint
+
+
+
+def processBacklogFile(torque_date, cfg, torque_accounting_dir, hostname, user_map, vo_map,
+                       log_records, batch_records):
+    """
+    Generates usage records from a closed Torque accounting log file, in a
+    worker process.
+    """
+    missing_user_mappings = {}
+    run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
+    aggregator = aggregate.createAggregator(cfg)
+    tlp = TorqueBlockLogParser(os.path.join(torque_accounting_dir, torque_date))
+    ur_spool = upload.createSpool(cfg, run_metrics)
+    job_id, checkpoint = processLogFile(tlp, torque_date, hostname, user_map, vo_map,
+                                        ur_spool, missing_user_mappings, run_metrics=run_metrics,
+                                        log_records=log_records, batch_records=batch_records,
+                                        aggregator=aggregator)
+    ur_spool.close()
+    return job_id, checkpoint, missing_user_mappings, run_metrics, aggregator
 
-            ur = createUsageRecord(log_entry, hostname, user_map, vo_map, missing_user_mappings)
-            log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
-            ur_dir = os.path.join(log_dir, 'urs')
-            if not os.path.exists(ur_dir):
-                os.makedirs(ur_dir)
 
-            ur_file = os.path.join(ur_dir, job_id)
-            ur.writeXML(ur_file)
-            common.writeGeneratorState(cfg, job_id, torque_date)
-            logging.info('Wrote usage record to %s' % ur_file)
 
-            job_id = None
+def generateUsageRecords(cfg, hostname, user_map, vo_map, follow=False, run_metrics=None):
+    """
+    Starts the UR generation process. If follow is True, the accounting log is
+    followed for new entries, until the process is stopped. Counters and
+    timings of the run are added to run_metrics.
+    """
+
+    torque_spool_dir = config.getConfigValue(cfg, config.SECTION_TORQUE,
+                                             config.TORQUE_SPOOL_DIR, config.DEFAULT_TORQUE_SPOOL_DIR)
+    torque_accounting_dir = os.path.join(torque_spool_dir, 'server_priv', 'accounting')
+
+    torque_date_today = time.strftime(TORQUE_DATE_FORMAT, time.gmtime())
+    job_id, torque_date, checkpoint = common.getGeneratorState(cfg, TORQUE_DATE_FORMAT)
+
+    if run_metrics is None:
+        run_metrics = metrics.Metrics(metrics.GENERATOR_METRICS)
+    log_records = metrics.isRecordLoggingEnabled(cfg)
+    batch_records = common.getBatchRecords(cfg)
+
+    ur_spool = upload.createSpool(cfg, run_metrics)
+    aggregator = aggregate.createAggregator(cfg)
+    state_writer = common.GeneratorStateWriter(cfg, ur_spool, run_metrics, aggregator)
+    workers = common.getWorkerCount(cfg)
+    missing_user_mappings = {}
+
+    def backlogFileProcessed(log_date, result):
+        last_job_id, last_checkpoint, missing, worker_metrics, worker_aggregator = result
+        missing_user_mappings.update(missing)
+        run_metrics.merge(worker_metrics)
+        if aggregator is not None:
+            aggregator.merge(worker_aggregator)
+        if last_job_id is not None:
+            state_writer.update(last_job_id, log_date, last_checkpoint)
+        state_writer.commit()
+
+    while True:
+
+        if job_id is None and workers > 1 and torque_date != torque_date_today:
+            # no partially processed log file, the closed ones can be processed in parallel
+            dates = common.getBacklogDates(torque_date, torque_date_today, TORQUE_DATE_FORMAT)
+            args = (cfg, torque_accounting_dir, hostname, user_map, vo_map, log_records, batch_records)
+            common.processBacklogFiles(workers, processBacklogFile, args, dates, backlogFileProcessed)
+            torque_date = torque_date_today
+
+        # only the log of today can still be written to, the closed ones are read to the end
+        tlp = TorqueBlockLogParser(os.path.join(torque_accounting_dir, torque_date),
+                                   follow=follow and torque_date == torque_date_today)
+        if job_id is not None:
+            tlp.spoolToCheckpoint(job_id, checkpoint)
+        processLogFile(tlp, torque_date, hostname, user_map, vo_map,
+                       ur_spool, missing_user_mappings, state_writer, torque_date == torque_date_today,
+                       run_metrics, log_records, batch_records, aggregator)
+        state_writer.commit()
 
         if torque_date == torque_date_today:
             break
 
         torque_date = common.getIncrementalDate(torque_date, TORQUE_DATE_FORMAT)
         job_id = None
+        checkpoint = None
+
+    if follow:
+        follow_interval = float(config.getConfigValue(cfg, config.SECTION_COMMON, config.FOLLOW_INTERVAL,
+                                                      config.DEFAULT_FOLLOW_INTERVAL))
+        logging.info('Following Torque accounting log %s' % tlp.log_file)
+        entries_read = None
+        try:
+            while True:
+                processLogFile(tlp, torque_date, hostname, user_map, vo_map,
+                               ur_spool, missing_user_mappings, state_writer, True, run_metrics, log_records,
+                               aggregator=aggregator)
+                state_writer.commit()
+
+                next_date = common.getNextLogDate(torque_accounting_dir, torque_date, TORQUE_DATE_FORMAT)
+                if next_date is not None:
+                    # torque has moved on to a later day, get the last entries in the current log
+                    tlp.follow = False # the log is closed, so a last line without newline is complete
+                    processLogFile(tlp, torque_date, hostname, user_map, vo_map,
+                                   ur_spool, missing_user_mappings, state_writer, True, run_metrics, log_records,
+                                   aggregator=aggregator)
+                    state_writer.commit()
+                    torque_date = next_date
+                    tlp = TorqueBlockLogParser(os.path.join(torque_accounting_dir, next_date), follow=follow)
+                    logging.info('Following Torque accounting log %s' % tlp.log_file)
+                    continue
+
+                if run_metrics.get('log_entries_read_total') != entries_read:
+                    # the run does not end, so the metrics are updated as new entries are processed
+                    entries_read = run_metrics.get('log_entries_read_total')
+                    run_metrics.write()
+                time.sleep(follow_interval)
+        finally:
+            state_writer.commit()
+            ur_spool.close()
+
+    ur_spool.close()
 
     if missing_user_mappings:
         users = ','.join(missing_user_mappings)
@@ -0,0 +1,486 @@
+#
+# Direct upload module.
+#
+# Module for the LRMS UR Generator module.
+#
+# With direct_upload=true in [common], the generator uploads the usage records
+# it creates to the registration services of the log_all and log_vo endpoints
+# itself, instead of leaving them in the spool for the registrant. Records are
+# buffered and uploaded in batches (one UsageRecords document per endpoint),
+# whenever batch_size records have been added and when the spool is flushed,
+# i.e., before the generator state is committed.
+#
+# Records uploaded to all of their endpoints are archived in the bundle of the
+# day, as the registrant does. Records which could not be uploaded to one or
+# more endpoints are written to the configured spool, and the endpoints they
+# were uploaded to are added to the registration state of the registrant
+# (registrations.db), so the registrant only registers them to the endpoints
+# that failed. The registrant therefore still has to run, to register these
+# records and to expire the archive.
+#
+# The log points are configured, and the registration services of the
+# endpoints are discovered and cached, as for the registrant (see the
+# registration module).
+
+import os
+import gzip
+import time
+import random
+import socket
+import logging
+import httplib
+import urlparse
+from StringIO import StringIO
+from xml.parsers import expat
+
+try:
+    import ssl
+except ImportError:
+    # Python 2.5 and older
+    ssl = None
+
+try:
+    import sqlite3
+except ImportError:
+    # Python 2.4 compatability
+    from pysqlite2 import dbapi2 as sqlite3
+
+from lrmsurgen import config, registration, spool, usagerecord
+
+
+
+UPLOAD_TIMEOUT = 60 # seconds, per request
+MAX_REDIRECTS  = 5  # when fetching service documents
+
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 5000
+
+MAX_RETRY_DELAY = 10 # seconds, the generator waits for the retries
+
+
+
+class UploadError(Exception):
+
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        self.code = code # response code, if the server responded
+
+
+
+def hasSSLContext():
+    """
+    Returns True if server certificates can be verified (Python 2.7.9 and
+    later), which direct upload requires.
+    """
+    return ssl is not None and hasattr(ssl, 'SSLContext')
+
+
+def stripXMLHeader(data):
+    """
+    Returns a serialized usage record without its XML declaration.
+    """
+    if data.startswith(usagerecord.XML_HEADER):
+        return data[len(usagerecord.XML_HEADER):]
+    if data.startswith('<?xml'):
+        return data[data.find('?>')+2:].lstrip()
+    return data
+
+
+
+class RegistrationClient:
+    """
+    Blocking HTTP(S) client for the registration services. Connections are
+    kept open and reused between uploads to the same host.
+    """
+    def __init__(self, key_path, cert_path, ca_dir, service_cache, compress=(), timeout=UPLOAD_TIMEOUT):
+        self.key_path = key_path
+        self.cert_path = cert_path
+        self.ca_dir = ca_dir
+        self.service_cache = service_cache
+        self.compress = set(compress)
+        self.timeout = timeout
+        self.connections = {} # (scheme, host:port) -> connection
+        self.services = {}    # endpoint -> registration url
+        self.ssl_context = None
+
+
+    def _createSSLContext(self):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        ctx.load_cert_chain(self.cert_path, self.key_path)
+        # as the registrant, the peer certificate is verified, but not its host name
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(capath=self.ca_dir)
+        return ctx
+
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'http':
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+        if scheme != 'https':
+            raise UploadError('Unsupported url scheme: %s' % scheme)
+        if not hasSSLContext():
+            # records are never sent to a server which has not been verified
+            raise UploadError('Cannot verify %s, no SSLContext in this Python version' % netloc)
+        if self.ssl_context is None:
+            self.ssl_context = self._createSSLContext()
+        return httplib.HTTPSConnection(netloc, timeout=self.timeout, context=self.ssl_context)
+
+
+    def request(self, url, method='GET', payload=None, headers=None):
+        """
+        Perform a request, returns the response code, headers and body. A
+        connection which has been closed by the server since the last request
+        is opened again once.
+        """
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        key = (scheme, netloc)
+
+        for attempt in (0, 1):
+            conn = self.connections.get(key)
+            reused = conn is not None
+            if conn is None:
+                conn = self.connections[key] = self._connect(scheme, netloc)
+            try:
+                conn.request(method, path or '/', payload, headers or {})
+                response = conn.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                del self.connections[key]
+                if reused and attempt == 0:
+                    continue # keep-alive connection closed by the server
+                raise
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+                del self.connections[key]
+            return response.status, response.msg, body
+
+
+    def discover(self, ep):
+        """
+        Returns the registration service url of an endpoint, from the
+        service cache or its service document.
+        """
+        url = self.services.get(ep)
+        if url is None:
+            url = self.service_cache.get(ep)
+        if url is None:
+            location = ep
+            for _ in range(MAX_REDIRECTS):
+                code, headers, body = self.request(location)
+                if code in (301, 302, 303, 307, 308) and headers.getheader('location'):
+                    location = urlparse.urljoin(location, headers.getheader('location'))
+                    continue
+                break
+            if code != 200:
+                raise UploadError('Error fetching service document of %s (%i)' % (ep, code), code)
+            url = registration.parseServiceDocument(body, ep)
+            if url is None:
+                raise UploadError('Endpoint %s does not appear to have a registration service' % ep)
+            self.service_cache.set(ep, url)
+        self.services[ep] = url
+        return url
+
+
+    def forget(self, ep):
+        """
+        Forget the registration url of an endpoint, also in the service cache,
+        so it is discovered again.
+        """
+        if ep in self.services:
+            del self.services[ep]
+        self.service_cache.invalidate(ep)
+
+
+    def insert(self, ep, payload):
+        """
+        Upload a UsageRecords document to the registration service of an
+        endpoint. Raises UploadError if the upload is not accepted. Returns
+        the number of bytes sent.
+        """
+        url = self.discover(ep)
+        if ep in self.compress:
+            f = StringIO()
+            gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+            gz.write(payload)
+            gz.close()
+            data = f.getvalue()
+            code, _, body = self.request(url, 'POST', data, {'Content-Encoding': 'gzip'})
+            if code in registration.COMPRESSION_REJECTED_CODES:
+                logging.info('%s rejected compressed upload (%i), disabling compression' % (ep, code))
+                self.compress.discard(ep)
+            else:
+                self._checkResponse(ep, code, body)
+                return len(data)
+
+        code, _, body = self.request(url, 'POST', payload)
+        self._checkResponse(ep, code, body)
+        return len(payload)
+
+
+    def _checkResponse(self, ep, code, body):
+        if code == 404 or 300 <= code < 400:
+            self.forget(ep) # service moved, discover it again next time
+        if code < 200 or code >= 300:
+            raise UploadError('Upload to %s failed (%i: %s)' % (ep, code, body[:200].strip()), code)
+
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+
+
+def isRetryable(e):
+    """
+    Returns True if a failed upload could succeed if tried again (as for
+    the registrant).
+    """
+    if isinstance(e, UploadError):
+        return e.code is not None and registration.isRetryableCode(e.code)
+    return isinstance(e, (EnvironmentError, httplib.HTTPException))
+
+
+
+def addRegistrations(log_dir, registrations):
+    """
+    Add (record, endpoint) pairs to the registration state of the registrant.
+    """
+    db = sqlite3.connect(os.path.join(log_dir, spool.REGISTRATIONS_DATABASE))
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS registrations ('
+                   'record TEXT NOT NULL, endpoint TEXT NOT NULL, PRIMARY KEY (record, endpoint))')
+        db.executemany('INSERT OR IGNORE INTO registrations VALUES (?, ?)', registrations)
+        db.commit()
+    finally:
+        db.close()
+
+
+
+class UploadSpool:
+    """
+    Spool which uploads usage records directly to their endpoints, and adds
+    the records which could not be uploaded to all of them to another spool.
+    Has the interface of the spools in the spool module (add, flush, close).
+
+    Failed uploads are retried as by the registrant, and after threshold
+    consecutive failures the records for the endpoint are spooled without
+    trying to upload them for cooldown seconds. After the cooldown a single
+    failure is enough to spool them again.
+    """
+    def __init__(self, fallback_spool, log_dir, client, log_all, log_vo, batch_size=config.DEFAULT_UPLOAD_BATCH_SIZE,
+                 max_retries=registration.DEFAULT_MAX_RETRIES, retry_backoff=registration.DEFAULT_RETRY_BACKOFF,
+                 threshold=registration.DEFAULT_BREAKER_THRESHOLD, cooldown=registration.DEFAULT_BREAKER_COOLDOWN,
+                 run_metrics=None):
+        self.fallback_spool = fallback_spool
+        self.log_dir = log_dir
+        self.archive_dir = os.path.join(log_dir, spool.ARCHIVE_DIRECTORY)
+        self.client = client
+        self.log_all = log_all
+        self.log_vo = log_vo
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.run_metrics = run_metrics
+        self.records = []  # (name, vo names, serialized record without xml declaration)
+        self.failures = {} # endpoint -> consecutive failed uploads
+        self.opened = {}   # endpoint -> time uploads were stopped
+
+
+    def getEndpoints(self, vo_names):
+        endpoints = list(self.log_all)
+        for vo_name in vo_names:
+            ep = self.log_vo.get(vo_name)
+            if ep and not ep in endpoints:
+                endpoints.append(ep)
+        return endpoints
+
+
+    def add(self, name, ur, data=None):
+        """
+        Add a usage record for upload, returns the location of the record.
+        The record is serialized, unless data (the serialized record) is given.
+        """
+        if data is None:
+            data = ur.toXMLElement()
+        else:
+            data = stripXMLHeader(data)
+        self.records.append( (name, ur, data) )
+        if len(self.records) >= self.batch_size:
+            self.upload()
+        return 'upload:%s' % name
+
+
+    def _isAvailable(self, ep):
+        opened = self.opened.get(ep)
+        return opened is None or opened + self.cooldown < time.time()
+
+
+    def _success(self, ep):
+        self.failures.pop(ep, None)
+        if self.opened.pop(ep, None) is not None:
+            logging.info('Uploads to %s resumed' % ep)
+
+
+    def _uploadBatch(self, ep, batch):
+        """
+        Upload records to an endpoint, returns True if they were accepted.
+        """
+        if not self._isAvailable(ep):
+            return False
+        payload = usagerecord.joinUsageRecords([ data for _, _, data in batch ])
+        retry = 0
+        while True:
+            t0 = time.time()
+            try:
+                sent = self.client.insert(ep, payload)
+                break
+            except (UploadError, EnvironmentError, httplib.HTTPException, ValueError, SyntaxError, expat.ExpatError), e:
+                if self.run_metrics is not None:
+                    self.run_metrics.inc('upload_failures_total', endpoint=ep)
+                if not isRetryable(e):
+                    self._success(ep) # the endpoint is available, even if it did not accept the upload
+                    logging.error('Error uploading %i usage records to %s (%s), spooling them' % (len(batch), ep, e))
+                    return False
+                self.failures[ep] = self.failures.get(ep, 0) + 1
+                if self.failures[ep] >= self.threshold:
+                    logging.error('Error uploading %i usage records to %s (%s), %i consecutive failures, '
+                                  'spooling records for %s for %i seconds' %
+                                  (len(batch), ep, e, self.failures[ep], ep, self.cooldown))
+                    self.opened[ep] = time.time()
+                    return False
+                if retry >= self.max_retries:
+                    logging.error('Error uploading %i usage records to %s (%s), spooling them' % (len(batch), ep, e))
+                    return False
+                retry += 1
+                delay = min(MAX_RETRY_DELAY, self.retry_backoff * 2 ** (retry - 1))
+                delay = delay / 2.0 + random.uniform(0, delay / 2.0) # jitter, as for the registrant
+                logging.warning('Retry %i of upload to %s in %.1f seconds (%s)' % (retry, ep, delay, e))
+                if self.run_metrics is not None:
+                    self.run_metrics.inc('upload_retries_total', endpoint=ep)
+                time.sleep(delay)
+
+        self._success(ep)
+        if self.run_metrics is not None:
+            self.run_metrics.inc('records_uploaded_total', len(batch), endpoint=ep)
+            self.run_metrics.inc('bytes_uploaded_total', sent, endpoint=ep)
+            self.run_metrics.observe('upload_latency_seconds', time.time() - t0, endpoint=ep)
+        return True
+
+
+    def upload(self):
+        """
+        Upload the buffered records. Records uploaded to all their endpoints
+        are archived, the others are added to the fallback spool.
+        """
+        records, self.records = self.records, []
+        if not records:
+            return
+        t0 = time.time()
+
+        routes = {} # endpoint -> records
+        record_endpoints = []
+        for record in records:
+            endpoints = self.getEndpoints([ voi.name for voi in record[1].vo_info if voi.name ])
+            record_endpoints.append(endpoints)
+            for ep in endpoints:
+                routes.setdefault(ep, []).append(record)
+
+        uploaded = set()
+        for ep, batch in routes.items():
+            if self._uploadBatch(ep, batch):
+                uploaded.add(ep)
+
+        registrations = []
+        spooled = []
+        archive_writer = None
+        for record, endpoints in zip(records, record_endpoints):
+            name = record[0]
+            done = [ ep for ep in endpoints if ep in uploaded ]
+            if endpoints and len(done) == len(endpoints):
+                if archive_writer is None:
+                    archive_writer = spool.BundleWriter(self.archive_dir)
+                archive_writer.add(name, usagerecord.XML_HEADER + record[2])
+            else:
+                registrations += [ (name, ep) for ep in done ]
+                spooled.append(record)
+
+        if archive_writer is not None:
+            archive_writer.close()
+        # the registration state must be there before the registrant can see the records
+        if registrations:
+            addRegistrations(self.log_dir, registrations)
+        for name, ur, data in spooled:
+            self.fallback_spool.add(name, ur, usagerecord.XML_HEADER + data)
+
+        if self.run_metrics is not None:
+            self.run_metrics.inc('records_spooled_total', len(spooled))
+            self.run_metrics.inc('stage_seconds_total', time.time() - t0, stage='upload')
+
+
+    def flush(self):
+        """
+        Upload the buffered records and flush the fallback spool, so every
+        record added is either uploaded or spooled.
+        """
+        self.upload()
+        self.fallback_spool.flush()
+
+
+    def close(self):
+        self.flush()
+        self.client.close()
+        self.fallback_spool.close()
+
+
+
+def isEnabled(cfg):
+    value = config.getConfigValue(cfg, config.SECTION_COMMON, config.DIRECT_UPLOAD, config.DEFAULT_DIRECT_UPLOAD)
+    return str(value).lower() in ('true', 'yes', '1')
+
+
+def createSpool(cfg, run_metrics=None):
+    """
+    Create the spool of the generator: an UploadSpool if direct upload is
+    enabled (and log points are configured), otherwise the configured spool.
+    """
+    ur_spool = spool.createSpool(cfg)
+    if not isEnabled(cfg):
+        return ur_spool
+    if not hasSSLContext():
+        # the registrant verifies the servers, so leave the records to it
+        logging.warning('Direct upload enabled, but server certificates cannot be verified '
+                        'with this Python version (no SSLContext), spooling usage records')
+        return ur_spool
+
+    getOption = lambda section, option, default=None : \
+                registration.getConfigOption(cfg, section, option, default)
+
+    log_all = registration.parseLogAll(getOption(config.SECTION_LOGGER, config.LOG_ALL))
+    log_vo  = registration.parseLogVO(getOption(config.SECTION_LOGGER, config.LOG_VO))
+    if not (log_all or log_vo):
+        logging.warning('Direct upload enabled, but no log points given, spooling usage records')
+        return ur_spool
+
+    log_dir = config.getConfigValue(cfg, config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)
+    batch_size = int(getOption(config.SECTION_LOGGER, config.BATCH_SIZE, config.DEFAULT_UPLOAD_BATCH_SIZE))
+    max_retries = int(getOption(config.SECTION_LOGGER, config.MAX_RETRIES, registration.DEFAULT_MAX_RETRIES))
+    retry_backoff = float(getOption(config.SECTION_LOGGER, config.RETRY_BACKOFF, registration.DEFAULT_RETRY_BACKOFF))
+    threshold = int(getOption(config.SECTION_LOGGER, config.BREAKER_THRESHOLD, registration.DEFAULT_BREAKER_THRESHOLD))
+    cooldown = float(getOption(config.SECTION_LOGGER, config.BREAKER_COOLDOWN, registration.DEFAULT_BREAKER_COOLDOWN))
+    discovery_ttl = float(getOption(config.SECTION_LOGGER, config.DISCOVERY_TTL, registration.DEFAULT_DISCOVERY_TTL))
+    compress = registration.parseCompress(getOption(config.SECTION_LOGGER, config.COMPRESS), log_all, log_vo)
+
+    client = RegistrationClient(getOption(config.SECTION_COMMON, config.HOSTKEY, config.DEFAULT_HOSTKEY),
+                                getOption(config.SECTION_COMMON, config.HOSTCERT, config.DEFAULT_HOSTCERT),
+                                getOption(config.SECTION_COMMON, config.CERTDIR, config.DEFAULT_CERTDIR),
+                                registration.ServiceCache(log_dir, discovery_ttl), compress)
+    return UploadSpool(ur_spool, log_dir, client, log_all, log_vo,
+                       min(MAX_BATCH_SIZE, max(MIN_BATCH_SIZE, batch_size)),
+                       max_retries, retry_backoff, threshold, cooldown, run_metrics)
@@ -30,6 +30,7 @@ SGAS_AT_NAMESPACE = "http://www.sgas.se/namespaces/2009/07/ur"
 LOGGER_NAMESPACE  = "http://www.sgas.se/namespaces/2010/08/logger"
 
 # job usage element/attribute names
+USAGE_RECORDS        = ET.QName("{%s}UsageRecords"   % OGF_UR_NAMESPACE)
 JOB_USAGE_RECORD     = ET.QName("{%s}JobUsageRecord" % OGF_UR_NAMESPACE)
 
 RECORD_IDENTITY      = ET.QName("{%s}RecordIdentity" % OGF_UR_NAMESPACE)
@@ -95,9 +96,20 @@ register_namespace('vo', SGAS_VO_NAMESPACE)
 register_namespace('sgas', SGAS_AT_NAMESPACE)
 register_namespace('logger', LOGGER_NAMESPACE)
 
+# namespace prefixes for the serializer, must match the registered ones
+NAMESPACE_PREFIXES = {
+    OGF_UR_NAMESPACE  : 'ur',
+    DEISA_NAMESPACE   : 'deisa',
+    SGAS_VO_NAMESPACE : 'vo',
+    SGAS_AT_NAMESPACE : 'sgas',
+    LOGGER_NAMESPACE  : 'logger'
+}
 
 
-class VOInformation:
+
+class VOInformation(object):
+
+    __slots__ = ('name', 'type_', 'issuer', 'attributes')
 
     def __init__(self, name=None, type_=None, issuer=None):
         self.name = name
@@ -107,7 +119,19 @@ class VOInformation:
 
 
 
-class UsageRecord:
+class UsageRecord(object):
+
+    # slots instead of a per-instance dict, as large numbers of records can
+    # be held in memory (see UsageRecordBatch)
+    __slots__ = ('record_id', 'global_job_id', 'local_job_id', 'global_user_name', 'local_user_id',
+                 'job_name', 'status', 'machine_name', 'queue', 'host', 'node_count', 'processors',
+                 'submit_time', 'end_time', 'start_time', 'project_name', 'submit_host',
+                 'wall_duration', 'cpu_duration', 'charge', 'vo_info',
+                 'user_time', 'kernel_time', 'exit_code', 'major_page_faults', 'runtime_environments')
+
+    # logger attributes
+    logger_name    = LOGGER_NAME
+    logger_version = LOGGER_VERSION
 
     def __init__(self):
         self.record_id          = None
@@ -137,9 +161,6 @@ class UsageRecord:
         self.exit_code          = None
         self.major_page_faults  = None
         self.runtime_environments = []
-        # logger attributes
-        self.logger_name        = LOGGER_NAME
-        self.logger_version     = LOGGER_VERSION
 
 
     def generateTree(self):
@@ -150,7 +171,10 @@ class UsageRecord:
         # utility function, very handy
         def setElement(parent, name, text):
             element = ET.SubElement(parent, name)
-            element.text = str(text)
+            if type(text) is not unicode:
+                # byte strings are taken to be utf-8, like in toXML
+                text = str(text).decode('utf-8')
+            element.text = text
 
         # begin method
 
@@ -159,7 +183,7 @@ class UsageRecord:
         assert self.record_id is not None, "No recordId specified, cannot generate usage record"
         record_identity = ET.SubElement(ur, RECORD_IDENTITY)
         record_identity.set(RECORD_ID, self.record_id)
-        record_identity.set(CREATE_TIME, time.strftime(ISO_TIME_FORMAT, time.gmtime()) + 'Z')
+        record_identity.set(CREATE_TIME, getCreateTime())
 
         if self.global_job_id is not None or self.local_job_id is not None:
             job_identity = ET.SubElement(ur, JOB_IDENTITY)
@@ -179,8 +203,8 @@ class UsageRecord:
             for voi in self.vo_info:
 
                 vo = ET.SubElement(user_identity, VO)
-                if voi.type is not None:
-                    vo.attrib[VO_TYPE] = voi.type
+                if voi.type_ is not None:
+                    vo.attrib[VO_TYPE] = voi.type_
                 setElement(vo, VO_NAME, voi.name)
                 if voi.issuer is not None:
                     setElement(vo, VO_ISSUER, voi.issuer)
@@ -226,14 +250,245 @@ class UsageRecord:
         return ET.ElementTree(ur)
 
 
+    def toXML(self):
+        """
+        Serializes the usage record into an XML document.
+
+        The document is written directly from element templates, instead of
+        building and serializing an element tree. The result is the same as
+        serializing the tree from generateTree.
+        """
+        return XML_HEADER + self.toXMLElement()
+
+
+    def toXMLElement(self):
+        """
+        Serializes the usage record into a JobUsageRecord element, without
+        the XML declaration (for joining records into one document).
+        """
+        assert self.record_id is not None, "No recordId specified, cannot generate usage record"
+
+        namespaces = [ OGF_UR_NAMESPACE, LOGGER_NAMESPACE ]
+        x = []
+
+        x.append(_RECORD_IDENTITY % (_escapeAttribute(getCreateTime()), _escapeAttribute(self.record_id)))
+
+        if self.global_job_id is not None or self.local_job_id is not None:
+            x.append(_JOB_IDENTITY_START)
+            if self.global_job_id is not None:  x.append(_element(GLOBAL_JOB_ID, self.global_job_id))
+            if self.local_job_id is not None:   x.append(_element(LOCAL_JOB_ID, self.local_job_id))
+            x.append(_JOB_IDENTITY_END)
+
+        if self.global_user_name is not None or self.local_job_id is not None:
+            user_identity = []
+            if self.local_user_id is not None:      user_identity.append(_element(LOCAL_USER_ID, self.local_user_id))
+            if self.global_user_name is not None:   user_identity.append(_element(GLOBAL_USER_NAME, self.global_user_name))
+
+            # vo stuff belongs under user identity
+            for voi in self.vo_info:
+                if voi.type_ is not None:
+                    user_identity.append(_VO_TYPE_START % _escapeAttribute(voi.type_))
+                else:
+                    user_identity.append(_VO_START)
+                user_identity.append(_element(VO_NAME, voi.name))
+                if voi.issuer is not None:
+                    user_identity.append(_element(VO_ISSUER, voi.issuer))
+
+                for attrs in voi.attributes:
+                    group, role, capability = attrs
+                    user_identity.append(_VO_ATTRIBUTE_START)
+                    user_identity.append(_element(VO_GROUP, group))
+                    if role is not None:        user_identity.append(_element(VO_ROLE, role))
+                    if capability is not None:  user_identity.append(_element(VO_CAPABILITY, capability))
+                    user_identity.append(_VO_ATTRIBUTE_END)
+                user_identity.append(_VO_END)
+
+            if self.vo_info:
+                namespaces.append(SGAS_VO_NAMESPACE)
+            if user_identity:
+                x.append(_USER_IDENTITY_START)
+                x += user_identity
+                x.append(_USER_IDENTITY_END)
+            else:
+                x.append(_USER_IDENTITY_EMPTY)
+
+        if self.job_name       is not None :  x.append(_element(JOB_NAME, self.job_name))
+        if self.charge         is not None :  x.append(_element(CHARGE, self.charge))
+        if self.status         is not None :  x.append(_element(STATUS, self.status))
+        if self.machine_name   is not None :  x.append(_element(MACHINE_NAME, self.machine_name))
+        if self.queue          is not None :  x.append(_element(QUEUE, self.queue))
+        if self.host           is not None :  x.append(_element(HOST, self.host))
+        if self.node_count     is not None :  x.append(_element(NODE_COUNT, self.node_count))
+        if self.processors     is not None :  x.append(_element(PROCESSORS, self.processors))
+        if self.submit_host    is not None :  x.append(_element(SUBMIT_HOST, self.submit_host))
+        if self.project_name   is not None :  x.append(_element(PROJECT_NAME, self.project_name))
+        if self.submit_time    is not None :
+            x.append(_element(SUBMIT_TIME, self.submit_time))
+            namespaces.append(DEISA_NAMESPACE)
+        if self.start_time     is not None :  x.append(_element(START_TIME, self.start_time))
+        if self.end_time       is not None :  x.append(_element(END_TIME, self.end_time))
+        if self.wall_duration  is not None :  x.append(_element(WALL_DURATION, "PT%fS" % self.wall_duration))
+        if self.cpu_duration   is not None :  x.append(_element(CPU_DURATION, "PT%fS" % self.cpu_duration))
+        # sgas attributes
+        sgas_elements = len(x)
+        if self.user_time      is not None :  x.append(_element(SGAS_USER_TIME, "PT%fS" % self.user_time))
+        if self.kernel_time    is not None :  x.append(_element(SGAS_KERNEL_TIME, "PT%fS" % self.kernel_time))
+        if self.exit_code      is not None :  x.append(_element(SGAS_EXIT_CODE, self.exit_code))
+        if self.major_page_faults is not None :
+            x.append(_element(SGAS_MAJOR_PAGE_FAULTS, self.major_page_faults))
+        for renv in self.runtime_environments:
+            x.append(_element(SGAS_RUNTIME_ENVIRONMENT, renv))
+        if len(x) > sgas_elements:
+            namespaces.append(SGAS_AT_NAMESPACE)
+
+        # set logger name and version
+        x.append(_LOGGER_NAME)
+        x.append(_JOB_USAGE_RECORD_END)
+
+        return _JOB_USAGE_RECORD_START % _namespaceDeclarations(namespaces) + ''.join(x)
+
+
     def writeXML(self, filename):
-        tree = self.generateTree()
         f = file(filename, 'w')
-        f.write(XML_HEADER)
-        tree.write(f, encoding='utf-8')
+        f.write(self.toXML())
+        f.close()
+
+
+class UsageRecordBatch(object):
+    """
+    A batch of usage records held in memory, serialized as one UsageRecords
+    document. Values which repeat between records (machine, queue, user,
+    project) are shared between the records in the batch.
+    """
+    __slots__ = ('records', 'values')
+
+    SHARED_FIELDS = ('machine_name', 'queue', 'local_user_id', 'global_user_name', 'project_name',
+                     'submit_host', 'status')
+
+    def __init__(self, records=()):
+        self.records = []
+        self.values = {}
+        for ur in records:
+            self.add(ur)
+
+
+    def add(self, ur):
+        values = self.values
+        for field in self.SHARED_FIELDS:
+            value = getattr(ur, field)
+            if value is not None:
+                setattr(ur, field, values.setdefault(value, value))
+        self.records.append(ur)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+    def toXML(self):
+        """
+        Serializes the records into a UsageRecords document (the document
+        the registrant uploads).
+        """
+        return joinUsageRecords([ ur.toXMLElement() for ur in self.records ])
+
+
+
+def joinUsageRecords(elements):
+    """
+    Joins serialized JobUsageRecord elements (see toXMLElement) into a
+    UsageRecords document.
+    """
+    return _USAGE_RECORDS_START + ''.join(elements) + _USAGE_RECORDS_END
+
 
 
 # ----
+# xml serialization templates and helpers (used by UsageRecord.toXML)
+
+def _tag(qname):
+    namespace, name = qname.text[1:].split('}')
+    return NAMESPACE_PREFIXES[namespace] + ':' + name
+
+
+def _escapeText(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _escapeAttribute(text):
+    text = _escapeText(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    return text
+
+
+def _namespaceDeclarations(namespaces):
+    # declared on the root element, sorted by prefix like element tree does
+    decls = [ (NAMESPACE_PREFIXES[ns], ns) for ns in namespaces ]
+    decls.sort()
+    return ''.join([ ' xmlns:%s="%s"' % decl for decl in decls ])
+
+
+_ELEMENT_TEMPLATES = {}
+
+def _element(qname, value):
+    if type(value) is unicode:
+        text = value.encode('utf-8')
+    else:
+        text = str(value)
+
+    try:
+        template, empty = _ELEMENT_TEMPLATES[qname]
+    except KeyError:
+        tag = _tag(qname)
+        template, empty = _ELEMENT_TEMPLATES[qname] = ('<%s>%%s</%s>' % (tag, tag), '<%s />' % tag)
+
+    if not text:
+        return empty
+    return template % _escapeText(text)
+
+
+_JOB_USAGE_RECORD_START = '<%s%%s>' % _tag(JOB_USAGE_RECORD)
+_JOB_USAGE_RECORD_END   = '</%s>' % _tag(JOB_USAGE_RECORD)
+_USAGE_RECORDS_START    = '<%s xmlns:ur="%s">\n' % (_tag(USAGE_RECORDS), OGF_UR_NAMESPACE)
+_USAGE_RECORDS_END      = '</%s>\n' % _tag(USAGE_RECORDS)
+_RECORD_IDENTITY        = '<%s %s="%%s" %s="%%s" />' % (_tag(RECORD_IDENTITY), _tag(CREATE_TIME), _tag(RECORD_ID))
+_JOB_IDENTITY_START     = '<%s>' % _tag(JOB_IDENTITY)
+_JOB_IDENTITY_END       = '</%s>' % _tag(JOB_IDENTITY)
+_USER_IDENTITY_START    = '<%s>' % _tag(USER_IDENTITY)
+_USER_IDENTITY_END      = '</%s>' % _tag(USER_IDENTITY)
+_USER_IDENTITY_EMPTY    = '<%s />' % _tag(USER_IDENTITY)
+_VO_START               = '<%s>' % _tag(VO)
+_VO_TYPE_START          = '<%s %s="%%s">' % (_tag(VO), _tag(VO_TYPE))
+_VO_END                 = '</%s>' % _tag(VO)
+_VO_ATTRIBUTE_START     = '<%s>' % _tag(VO_ATTRIBUTE)
+_VO_ATTRIBUTE_END       = '</%s>' % _tag(VO_ATTRIBUTE)
+_LOGGER_NAME            = '<%s %s="%s">%s</%s>' % (_tag(LOGGER_NAME), _tag(LOGGER_VERSION), LOGGER_VERSION_VALUE,
+                                                   LOGGER_NAME_VALUE, _tag(LOGGER_NAME))
+
+# create time is the same for all records created within a second
+_create_time = [ None, None ]
+
+def getCreateTime():
+    now = int(time.time())
+    if _create_time[0] != now:
+        _create_time[0] = now
+        _create_time[1] = time.strftime(ISO_TIME_FORMAT, time.gmtime(now)) + 'Z'
+    return _create_time[1]
+
+
 
 def gm2isoTime(gm_time):
     return time.strftime(ISO_TIME_FORMAT, gm_time) + "Z"
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Tests of the batch (columnar) creation of usage records.
+#
+# Checks that createUsageRecords gives the same records as createUsageRecord
+# for each entry, for both Torque and Maui. The columnar module is run without
+# numpy, and with numpy when it can be imported.
+#
+# Usage: python tests/test_columnar.py
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lrmsurgen import columnar, maui, torque, usagerecord
+
+try:
+    import numpy
+    if not hasattr(numpy, 'datetime_as_string'):
+        numpy = None # too old for the columnar module
+except ImportError:
+    numpy = None
+
+
+HOSTNAME = 'ce.example.org'
+USER_MAP = { 'user01' : '/O=Grid/O=Example/CN=User 01' }
+VO_MAP   = { 'user01' : 'vo1.example.org', 'account1' : 'vo2.example.org' }
+
+CREATE_TIME_ATTRIBUTE = re.compile('createTime="[^"]*"')
+
+
+
+def torqueEntry(job_id, ctime, start, end, cput, walltime, nodes, account=None):
+    entry = { 'entrytype' : 'E', 'jobid' : job_id, 'user' : 'user01', 'queue' : 'grid',
+              'ctime' : str(ctime), 'start' : str(start), 'end' : str(end),
+              'resources_used.cput' : cput, 'resources_used.walltime' : walltime,
+              'Resource_List.nodes' : nodes, 'exec_host' : 'n01/0+n01/1+n02/0' }
+    if account is not None:
+        entry['account'] = account
+    return entry
+
+
+def mauiEntry(job_id, submit, start, end, alo_tasks, utilized_cpu, task_cores, account='[NONE]'):
+    entry = [ '0' ] * 38
+    entry[0]  = job_id
+    entry[3]  = 'user01'
+    entry[6]  = 'Completed'
+    entry[7]  = '[grid:1]'
+    entry[8]  = str(submit)
+    entry[10] = str(start)
+    entry[11] = str(end)
+    entry[21] = str(alo_tasks)
+    entry[25] = account
+    entry[29] = str(utilized_cpu)
+    entry[31] = str(task_cores)
+    entry[37] = 'n01:n02'
+    return entry
+
+
+TORQUE_ENTRIES = [
+    torqueEntry('1', 1280000000, 1280000100, 1280003600, '00:58:20', '00:58:20', 'n01:ppn=2+n02'),
+    torqueEntry('2', 0, 0, 0, '00:00:00', '00:00:00', '1'), # epoch 0
+    torqueEntry('3', 1280000000, 1280000100, 1280086500, '100:00:01', '24:00:00', '2:ppn=8', 'account1'),
+    torqueEntry('4.other.example.org', 1293839999, 1293839999, 1293840000, '00:00:01', '00:00:01', 'n03'),
+]
+
+MAUI_ENTRIES = [
+    mauiEntry('1', 1280000000, 1280000100, 1280003600, 4, 12000.5, 1),
+    mauiEntry('2', 1280000000, 1280000100, 1280003600, 4, 100000.0, 2), # cpu time above wall time * tasks
+    mauiEntry('3', 0, 0, 0, 0, 0.0, 1), # epoch 0, no tasks
+    mauiEntry('4', 1280000000, 1280000100, 1280000100, 0, 0.0, 1, 'account1'), # no tasks, no cpu time
+    mauiEntry('5', 1293839999, 1293839999, 1293840000, 1, 0.25, 8),
+]
+
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.columnar_numpy = columnar.numpy
+
+
+    def tearDown(self):
+        columnar.numpy = self.columnar_numpy
+
+
+    def getNumpyModes(self):
+        """
+        Returns the numpy modules to run the columnar module with.
+        """
+        if numpy is None:
+            return [ None ]
+        return [ None, numpy ]
+
+
+    def assertSameRecords(self, single_records, batch_records):
+        self.assertEqual(len(single_records), len(batch_records))
+        for single_ur, batch_ur in zip(single_records, batch_records):
+            self.assertEqual(CREATE_TIME_ATTRIBUTE.sub('', single_ur.toXML()),
+                             CREATE_TIME_ATTRIBUTE.sub('', batch_ur.toXML()))
+
+
+    def testTorque(self):
+        for numpy_module in self.getNumpyModes():
+            columnar.numpy = numpy_module
+            single_records = [ torque.createUsageRecord(entry, HOSTNAME, USER_MAP, VO_MAP, {})
+                               for entry in TORQUE_ENTRIES ]
+            batch_records = torque.createUsageRecords(TORQUE_ENTRIES, HOSTNAME, USER_MAP, VO_MAP, {})
+            self.assertSameRecords(single_records, batch_records)
+
+
+    def testMaui(self):
+        for numpy_module in self.getNumpyModes():
+            columnar.numpy = numpy_module
+            single_records = [ maui.createUsageRecord(entry, HOSTNAME, USER_MAP, VO_MAP, 'maui.example.org', {})
+                               for entry in MAUI_ENTRIES ]
+            batch_records = maui.createUsageRecords(MAUI_ENTRIES, HOSTNAME, USER_MAP, VO_MAP, 'maui.example.org', {})
+            self.assertSameRecords(single_records, batch_records)
+            self.assertEqual(batch_records[1].cpu_duration, 100000.0 / 4)
+
+
+    def testMauiZeroTasks(self):
+        # cpu time with no tasks cannot be corrected, in either case
+        entries = MAUI_ENTRIES + [ mauiEntry('6', 1280000000, 1280000100, 1280003600, 0, 10.0, 1) ]
+        for numpy_module in self.getNumpyModes():
+            columnar.numpy = numpy_module
+            self.assertRaises(ZeroDivisionError, maui.createUsageRecord,
+                              entries[-1], HOSTNAME, USER_MAP, VO_MAP, 'maui.example.org', {})
+            self.assertRaises(ZeroDivisionError, maui.createUsageRecords,
+                              entries, HOSTNAME, USER_MAP, VO_MAP, 'maui.example.org', {})
+
+
+    def testIsoTimes(self):
+        epoch_times = [ 0, 59, 86399, 86400, 951782400, 1280000000, 2147483647 ]
+        for numpy_module in self.getNumpyModes():
+            columnar.numpy = numpy_module
+            self.assertEqual(columnar.isoTimes(columnar.intColumn([ str(t) for t in epoch_times ])),
+                             [ usagerecord.epoch2isoTime(t) for t in epoch_times ])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Tests of usage record serialization.
+#
+# Checks that the template serializer (UsageRecord.toXML) writes the same
+# documents as serializing the element tree from UsageRecord.generateTree.
+#
+# Usage: python tests/test_usagerecord.py
+#
+# Module for the LRMS UR Generator module.
+
+import os
+import re
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lrmsurgen import usagerecord
+from lrmsurgen.usagerecord import ET
+
+
+CREATE_TIME_ATTRIBUTE = re.compile('createTime="[^"]*"')
+
+
+
+def serializeTree(ur):
+    f = StringIO()
+    f.write(usagerecord.XML_HEADER)
+    ur.generateTree().write(f, encoding='utf-8')
+    return f.getvalue()
+
+
+def createUsageRecord():
+    """
+    Create a usage record with the fields the generator sets.
+    """
+    ur = usagerecord.UsageRecord()
+    ur.record_id = 'host.example.org:1234.torque.example.org'
+    ur.local_job_id = '1234.torque.example.org'
+    ur.global_job_id = ur.record_id
+    ur.local_user_id = 'user01'
+    ur.global_user_name = '/O=Grid/O=Example/CN=User 01'
+    ur.machine_name = 'host.example.org'
+    ur.queue = 'grid'
+    ur.host = 'n01,n02'
+    ur.node_count = 2
+    ur.processors = 16
+    ur.project_name = 'project1'
+    ur.submit_time = usagerecord.epoch2isoTime(1280000000)
+    ur.start_time = usagerecord.epoch2isoTime(1280000100)
+    ur.end_time = usagerecord.epoch2isoTime(1280003600)
+    ur.wall_duration = 3500
+    ur.cpu_duration = 55012.5
+    return ur
+
+
+
+class SerializerTest(unittest.TestCase):
+
+    def assertSameDocument(self, ur):
+        tree_xml = CREATE_TIME_ATTRIBUTE.sub('', serializeTree(ur))
+        template_xml = CREATE_TIME_ATTRIBUTE.sub('', ur.toXML())
+        self.assertEqual(tree_xml, template_xml)
+        # and the document must be well-formed
+        ET.fromstring(ur.toXML())
+
+
+    def testRecord(self):
+        self.assertSameDocument(createUsageRecord())
+
+
+    def testMissingOptionalFields(self):
+        ur = usagerecord.UsageRecord()
+        ur.record_id = 'host.example.org:1'
+        self.assertSameDocument(ur)
+
+        ur.local_job_id = '1'
+        self.assertSameDocument(ur)
+
+        ur = createUsageRecord()
+        ur.global_user_name = None
+        ur.project_name = None
+        ur.submit_time = None
+        ur.queue = ''
+        self.assertSameDocument(ur)
+
+
+    def testVOInformation(self):
+        ur = createUsageRecord()
+        ur.vo_info.append(usagerecord.VOInformation(name='vo1.example.org', type_='lrmsurgen-vomap'))
+        self.assertSameDocument(ur)
+
+        voi = usagerecord.VOInformation(name='atlas', type_='voms', issuer='/CN=voms.example.org')
+        voi.attributes.append( ('/atlas', 'production', None) )
+        voi.attributes.append( ('/atlas/lcg1', None, 'NULL') )
+        ur.vo_info.append(voi)
+        ur.vo_info.append(usagerecord.VOInformation(name='untyped'))
+        self.assertSameDocument(ur)
+
+
+    def testSGASAttributes(self):
+        ur = createUsageRecord()
+        ur.user_time = 12.5
+        ur.kernel_time = 0.25
+        ur.exit_code = 0
+        ur.major_page_faults = 3
+        ur.runtime_environments = [ 'APPS/BIO/BLAST-2.2', 'ENV/JAVA' ]
+        self.assertSameDocument(ur)
+
+
+    def testEscaping(self):
+        ur = createUsageRecord()
+        ur.record_id = 'host.example.org:"1" & <2>\n'
+        ur.global_user_name = '/O=Grid/CN=User & <co> "quoted" \'single\''
+        ur.project_name = 'a>b'
+        ur.vo_info.append(usagerecord.VOInformation(name='vo & co', type_='"odd" <type>'))
+        self.assertSameDocument(ur)
+
+        root = ET.fromstring(ur.toXML())
+        record_identity = root.find(str(usagerecord.RECORD_IDENTITY))
+        self.assertEqual(record_identity.get(str(usagerecord.RECORD_ID)), ur.record_id)
+
+
+    def testNonASCII(self):
+        ur = createUsageRecord()
+        ur.global_user_name = '/O=Grid/CN=J\xc3\xb8rgen M\xc3\xbcller' # utf-8, as read from the logs
+        ur.project_name = u'proj\xe9t'
+        ur.vo_info.append(usagerecord.VOInformation(name=u'\u30b0\u30ea\u30c3\u30c9'))
+        self.assertSameDocument(ur)
+
+        root = ET.fromstring(ur.toXML())
+        self.assertEqual(root.find(str(usagerecord.PROJECT_NAME)).text, u'proj\xe9t')
+
+
+    def testBatch(self):
+        urs = [ createUsageRecord(), createUsageRecord() ]
+        urs[1].record_id = 'host.example.org:1235.torque.example.org'
+        batch = usagerecord.UsageRecordBatch(urs)
+        root = ET.fromstring(batch.toXML())
+        self.assertEqual(len(root), 2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()